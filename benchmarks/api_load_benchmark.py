@@ -0,0 +1,123 @@
+# api_load_benchmark.py
+# runs the API under uvicorn once per database mode and drives the same mixed read/write load at both
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.common import COLORS, latency_summary, record_result, seed_cars, start_api, use_database
+
+SORTS = ['id', '-id', 'price_mdl', '-price_mdl', 'kilometrage', '-created_at']
+
+def start_server(mode, args, database_url):
+  return start_api({
+    'DATABASE_URL': database_url,
+    'DB_ASYNC': '1' if mode == 'async' else '0',
+    'DB_POOL_SIZE': str(args.pool_size),
+    'DB_MAX_OVERFLOW': str(args.max_overflow),
+    # every request should reach the database
+    'RESPONSE_CACHE_TTL': '0',
+  })
+
+def random_request(rng, rows):
+  roll = rng.random()
+  car_id = rng.randint(1, rows)
+  if roll < 0.6:
+    params = {'limit': 20, 'sort': rng.choice(SORTS)}
+    if rng.random() < 0.5:
+      low = rng.uniform(100000, 180000)
+      params.update(price_min=low, price_max=low + 5000)
+    if rng.random() < 0.3:
+      params['color'] = rng.sample(COLORS[:-1], 2)
+    return 'list', 'GET', '/cars', params, None
+  if roll < 0.9:
+    return 'get', 'GET', f'/cars/{car_id}', None, None
+  body = {
+    'name': f'Load test {car_id}',
+    'price_mdl': round(rng.uniform(100000, 190000), 2),
+    'link': f'https://999.md/ro/load-{car_id}',
+    'kilometrage': rng.randint(0, 400000),
+    'color': rng.choice(COLORS),
+  }
+  return 'update', 'PUT', f'/cars/{car_id}', None, body
+
+def drive(base_url, args):
+  # each client loops over random requests until the time is up, returns per-operation latencies
+  stop = time.perf_counter() + args.warmup + args.duration
+  measure_from = time.perf_counter() + args.warmup
+  latencies = {'list': [], 'get': [], 'update': []}
+  statuses = Counter()
+  lock = threading.Lock()
+
+  def client(seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    while True:
+      started = time.perf_counter()
+      if started >= stop:
+        return
+      op, method, path, params, body = random_request(rng, args.rows)
+      try:
+        status = session.request(method, base_url + path, params=params, json=body, timeout=60).status_code
+      except requests.RequestException:
+        status = 'error'
+      elapsed = time.perf_counter() - started
+      if started >= measure_from:
+        with lock:
+          latencies[op].append(elapsed)
+          statuses[status] += 1
+
+  with ThreadPoolExecutor(max_workers=args.clients) as executor:
+    list(executor.map(client, range(args.clients)))
+
+  completed = sum(len(values) for values in latencies.values())
+  return {
+    'requests': completed,
+    'requests_per_sec': round(completed / args.duration, 2),
+    'errors': sum(count for status, count in statuses.items() if status == 'error' or status >= 500),
+    'statuses': {str(status): count for status, count in statuses.items()},
+    'latency': latency_summary([value for values in latencies.values() for value in values]),
+    **{f'{op}_latency': latency_summary(values) for op, values in latencies.items()},
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare the sync and async database modes of the API under load')
+  parser.add_argument('--rows', type=int, default=50_000)
+  parser.add_argument('--clients', type=int, default=64, help='concurrent HTTP clients')
+  parser.add_argument('--duration', type=float, default=15, help='measured seconds per mode')
+  parser.add_argument('--warmup', type=float, default=2)
+  parser.add_argument('--pool-size', type=int, default=10)
+  parser.add_argument('--max-overflow', type=int, default=10)
+  parser.add_argument('--modes', default='sync,async')
+  parser.add_argument('--database-url', default=None, help='defaults to BENCH_DATABASE_URL or a SQLite file under benchmarks/results')
+  parser.add_argument('--output', default=None, help='JSON lines file results are appended to')
+  args = parser.parse_args()
+
+  database_url = use_database(args.database_url)
+  seed_cars(args.rows)
+
+  metrics = {}
+  for mode in args.modes.split(','):
+    process, base_url = start_server(mode, args, database_url)
+    try:
+      print(f'{mode}: {args.clients} clients for {args.duration}s')
+      metrics[mode] = drive(base_url, args)
+    finally:
+      process.terminate()
+      process.wait()
+
+  config = {key: value for key, value in vars(args).items() if key != 'output'}
+  config['database'] = database_url.split(':')[0]
+  record_result('api_load', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
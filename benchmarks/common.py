@@ -0,0 +1,175 @@
+# common.py
+# helpers shared by the benchmark scripts
+import os
+import sys
+import json
+import time
+import random
+import socket
+import subprocess
+from datetime import datetime, timedelta
+from pathlib import Path
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+def percentile(values, pct):
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = (len(ordered) - 1) * pct / 100
+  low = int(rank)
+  high = min(low + 1, len(ordered) - 1)
+  return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def latency_summary(seconds):
+  # latencies in milliseconds
+  return {
+    'count': len(seconds),
+    'p50_ms': round(percentile(seconds, 50) * 1000, 3) if seconds else None,
+    'p99_ms': round(percentile(seconds, 99) * 1000, 3) if seconds else None,
+    'max_ms': round(max(seconds) * 1000, 3) if seconds else None,
+  }
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+def flatten(metrics, prefix=''):
+  flat = {}
+  for key, value in metrics.items():
+    if isinstance(value, dict):
+      flat.update(flatten(value, f'{prefix}{key}.'))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      flat[f'{prefix}{key}'] = value
+  return flat
+
+def record_result(name, config, metrics, output=None):
+  # appends one JSON line per run and prints the change against the previous run with the same config
+  path = Path(output) if output else RESULTS_DIR / f'{name}.jsonl'
+  path.parent.mkdir(parents=True, exist_ok=True)
+
+  previous = None
+  if path.exists():
+    with open(path) as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          continue
+        if entry.get('config') == config:
+          previous = entry
+
+  entry = {
+    'benchmark': name,
+    'timestamp': datetime.now().isoformat(),
+    'revision': git_revision(),
+    'config': config,
+    'metrics': metrics,
+  }
+  with open(path, 'a') as f:
+    f.write(json.dumps(entry) + '\n')
+
+  print(json.dumps(metrics, indent=2))
+  if previous:
+    print(f"change against run {previous.get('revision')} at {previous.get('timestamp')}:")
+    old = flatten(previous['metrics'])
+    for key, value in flatten(metrics).items():
+      if old.get(key):
+        print(f'  {key}: {old[key]} -> {value} ({(value - old[key]) / old[key] * 100:+.1f}%)')
+  print(f'results appended to {path}')
+  return entry
+
+BENCH_DATABASE_URL = f"sqlite:///{RESULTS_DIR / 'cars_bench.db'}"
+
+def use_database(url=None):
+  # database.py reads DATABASE_URL at import time, so call this before importing it
+  url = url or os.getenv('BENCH_DATABASE_URL') or BENCH_DATABASE_URL
+  if url.startswith('sqlite:///'):
+    Path(url[len('sqlite:///'):]).parent.mkdir(parents=True, exist_ok=True)
+  os.environ['DATABASE_URL'] = url
+  return url
+
+MODELS = [
+  'Volkswagen Passat', 'Volkswagen Golf', 'BMW 5 Series', 'BMW X5', 'Mercedes-Benz E-Class', 'Toyota Camry',
+  'Toyota RAV4', 'Dacia Logan', 'Skoda Octavia', 'Opel Astra', 'Ford Focus', 'Renault Megane', 'Audi A6', 'Honda Civic',
+]
+COLORS = ['Negru', 'Alb', 'Gri', 'Argintiu', 'Albastru', 'Roșu', 'Verde', 'Maro', '']
+
+def synthetic_car(i, rng, now):
+  return {
+    'name': f'{rng.choice(MODELS)} {rng.randint(2000, 2023)}',
+    'price_mdl': round(rng.uniform(5000, 10000) * 19.286, 2),
+    'link': f'https://999.md/ro/bench-{i}',
+    'kilometrage': rng.randint(0, 400000) if rng.random() > 0.05 else None,
+    'color': rng.choice(COLORS),
+    'created_at': now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+    'updated_at': now,
+  }
+
+def seed_cars(total, batch=10000):
+  # tops the cars table up to total rows of synthetic ads, returns the row count
+  from sqlalchemy import func, insert
+  from database import Session, Car, init_db
+
+  init_db()
+  db = Session()
+  try:
+    existing = db.query(func.count(Car.id)).scalar()
+    if existing >= total:
+      return existing
+    print(f'seeding cars: {existing} -> {total} rows')
+    rng = random.Random(existing)
+    now = datetime.utcnow()
+    for start in range(existing, total, batch):
+      rows = [synthetic_car(i, rng, now) for i in range(start, min(start + batch, total))]
+      db.execute(insert(Car), rows)
+      db.commit()
+    return total
+  finally:
+    db.close()
+
+def time_calls(call, repeat):
+  timings = []
+  for _ in range(repeat):
+    started = time.perf_counter()
+    call()
+    timings.append(time.perf_counter() - started)
+  return timings
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def start_api(env, timeout=30):
+  # runs webserver:app under uvicorn in a child process, returns (process, base_url) once it answers
+  import requests
+
+  port = free_port()
+  process = subprocess.Popen(
+    [sys.executable, '-m', 'uvicorn', 'webserver:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+    cwd=Path(__file__).resolve().parent.parent, env={**os.environ, **env}, stdout=subprocess.DEVNULL)
+  base_url = f'http://127.0.0.1:{port}'
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError(f'API server exited with {process.returncode}')
+    try:
+      requests.get(base_url + '/', timeout=1)
+      return process, base_url
+    except requests.ConnectionError:
+      time.sleep(0.2)
+  process.kill()
+  raise RuntimeError('API server did not start')
+
+def process_rss_kb(pid, field='VmRSS'):
+  # Linux only, None elsewhere
+  try:
+    with open(f'/proc/{pid}/status') as f:
+      for line in f:
+        if line.startswith(field + ':'):
+          return int(line.split()[1])
+  except OSError:
+    return None
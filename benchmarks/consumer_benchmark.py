@@ -0,0 +1,177 @@
+# consumer_benchmark.py
+# car_data ingest throughput: the old POST per car against CarSink's batched upserts
+# without --broker the messages are handed to the sink directly, with it they go through a real queue
+# and --workers spreads them over ConsumerPool processes
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.common import record_result, seed_cars, start_api, synthetic_car, use_database
+
+class AckLog:
+  # stands in for the channel when there is no broker, records what the sink settles
+  def __init__(self):
+    self.acked = 0
+    self.requeued = 0
+    self.rejected = 0
+
+  def basic_ack(self, delivery_tag, multiple=False):
+    self.acked = delivery_tag
+
+  def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+    self.requeued += 1
+
+  def basic_reject(self, delivery_tag, requeue=True):
+    self.rejected += 1
+
+def make_messages(count, cars_per_message, run):
+  # the scraper publishes products_filtered in batches, links are new for every run so the upserts insert
+  rng = random.Random(run)
+  now = datetime.utcnow()
+  messages = []
+  for m in range(count):
+    cars = []
+    for c in range(cars_per_message):
+      car = synthetic_car(m * cars_per_message + c, rng, now)
+      car['link'] = f"https://999.md/ro/consumer-{run}-{m}-{c}"
+      cars.append({key: car[key] for key in ('name', 'price_mdl', 'link', 'kilometrage', 'color')})
+    messages.append(json.dumps({'products_filtered': cars}).encode())
+  return messages
+
+def post_per_car(messages, base_url):
+  # what rabbitmq_consumer.callback used to do for every car
+  started = time.perf_counter()
+  for body in messages:
+    for car in json.loads(body)['products_filtered']:
+      requests.post(base_url + '/cars', json=car, headers={'Content-Type': 'application/json'}).raise_for_status()
+  return time.perf_counter() - started
+
+def sink_direct(messages, batch_size):
+  from rabbitmq_consumer import CarSink
+
+  channel = AckLog()
+  sink = CarSink(channel, batch_size=batch_size, max_messages=len(messages))
+  started = time.perf_counter()
+  for tag, body in enumerate(messages, 1):
+    sink.receive(tag, body)
+  sink.flush()
+  elapsed = time.perf_counter() - started
+  if channel.acked != len(messages):
+    raise RuntimeError(f'acked up to {channel.acked} of {len(messages)} messages')
+  return elapsed
+
+def sink_broker(messages, batch_size):
+  # publishes everything first, then times the consumer loop until the queue is drained
+  import pika
+  from rabbitmq_consumer import CarSink, QUEUE_NAME, connect
+
+  queue = QUEUE_NAME + '_bench'
+  connection, channel = connect(queue=queue)
+  channel.queue_purge(queue)
+  for body in messages:
+    channel.basic_publish(exchange='', routing_key=queue, body=body, properties=pika.BasicProperties(delivery_mode=2))
+  sink = CarSink(channel, batch_size=batch_size)
+  received = 0
+  started = time.perf_counter()
+  try:
+    for method, properties, body in channel.consume(queue, inactivity_timeout=1):
+      if method is None:
+        sink.flush()
+        break
+      sink.receive(method.delivery_tag, body)
+      received += 1
+      if received == len(messages):
+        sink.flush()
+        break
+    return time.perf_counter() - started
+  finally:
+    channel.cancel()
+    channel.queue_delete(queue)
+    connection.close()
+
+def pool_broker(messages, batch_size, workers, prefix):
+  # the same through ConsumerPool, done once every car of the run is in the table, worker start up included
+  import pika
+  from sqlalchemy import func
+  from database import Session, Car
+  from rabbitmq_consumer import ConsumerPool, QUEUE_NAME, connect
+
+  queue = QUEUE_NAME + '_bench'
+  connection, channel = connect(queue=queue)
+  channel.queue_purge(queue)
+  for body in messages:
+    channel.basic_publish(exchange='', routing_key=queue, body=body, properties=pika.BasicProperties(delivery_mode=2))
+  expected = sum(len(json.loads(body)['products_filtered']) for body in messages)
+  pool = ConsumerPool(workers, queue=queue, batch_size=batch_size)
+  started = time.perf_counter()
+  pool.start()
+  db = Session()
+  try:
+    while db.query(func.count(Car.id)).filter(Car.link.like(prefix + '%')).scalar() < expected:
+      pool.supervise()
+      db.rollback()
+      time.sleep(0.05)
+    return time.perf_counter() - started
+  finally:
+    db.close()
+    pool.stop()
+    channel.queue_delete(queue)
+    connection.close()
+
+def main():
+  parser = argparse.ArgumentParser(description='car_data ingest throughput, POST per car against the batched sink')
+  parser.add_argument('--messages', type=int, default=200)
+  parser.add_argument('--cars-per-message', type=int, default=50)
+  parser.add_argument('--batch-size', type=int, default=1000, help='cars per sink flush')
+  parser.add_argument('--rows', type=int, default=100000, help='rows seeded before the runs')
+  parser.add_argument('--broker', action='store_true', help='run the sink against RABBITMQ_HOST instead of handing it the messages')
+  parser.add_argument('--workers', type=int, default=1, help='with --broker, consumer processes started through ConsumerPool')
+  parser.add_argument('--skip-post', action='store_true', help="don't time the old POST per car path")
+  parser.add_argument('--database-url', default=None, help='defaults to BENCH_DATABASE_URL or a SQLite file under benchmarks/results')
+  parser.add_argument('--output', default=None, help='JSON lines file results are appended to')
+  args = parser.parse_args()
+
+  database_url = use_database(args.database_url)
+  seed_cars(args.rows)
+  cars = args.messages * args.cars_per_message
+  run = int(time.time())
+  metrics = {}
+
+  if not args.skip_post:
+    process, base_url = start_api({'DATABASE_URL': database_url})
+    try:
+      seconds = post_per_car(make_messages(args.messages, args.cars_per_message, f'{run}-post'), base_url)
+    finally:
+      process.terminate()
+      process.wait()
+    metrics['post_per_car'] = {'seconds': round(seconds, 3), 'cars_per_s': round(cars / seconds, 1)}
+    print(f"POST per car: {cars} cars in {seconds:.2f}s, {metrics['post_per_car']['cars_per_s']} cars/s")
+
+  messages = make_messages(args.messages, args.cars_per_message, f'{run}-sink')
+  if args.broker and args.workers > 1:
+    seconds = pool_broker(messages, args.batch_size, args.workers, f'https://999.md/ro/consumer-{run}-sink-')
+  elif args.broker:
+    seconds = sink_broker(messages, args.batch_size)
+  else:
+    seconds = sink_direct(messages, args.batch_size)
+  metrics['sink'] = {'seconds': round(seconds, 3), 'cars_per_s': round(cars / seconds, 1)}
+  print(f"batched sink: {cars} cars in {seconds:.2f}s, {metrics['sink']['cars_per_s']} cars/s")
+  if 'post_per_car' in metrics:
+    metrics['speedup'] = round(metrics['sink']['cars_per_s'] / metrics['post_per_car']['cars_per_s'], 1)
+    print(f"speedup: {metrics['speedup']}x")
+
+  config = {key: value for key, value in vars(args).items() if key != 'output'}
+  config['database'] = database_url.split(':')[0]
+  record_result('consumer', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
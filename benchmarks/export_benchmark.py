@@ -0,0 +1,86 @@
+# export_benchmark.py
+# downloads GET /cars/export at growing table sizes, first-byte latency and server memory should stay flat
+import sys
+import time
+import argparse
+import threading
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.common import process_rss_kb, record_result, seed_cars, start_api, use_database
+
+def download(base_url, pid, params):
+  # reads the raw body as it arrives, samples the server RSS meanwhile
+  peak = [process_rss_kb(pid) or 0]
+  done = threading.Event()
+
+  def sample():
+    while not done.wait(0.05):
+      peak[0] = max(peak[0], process_rss_kb(pid) or 0)
+
+  sampler = threading.Thread(target=sample, daemon=True)
+  sampler.start()
+  started = time.perf_counter()
+  first_byte = None
+  wire_bytes = 0
+  try:
+    with requests.get(base_url + '/cars/export', params=params, stream=True, timeout=600) as response:
+      response.raise_for_status()
+      # the body is chunked, stream() hands over each chunk as soon as it arrives
+      for chunk in response.raw.stream(65536, decode_content=False):
+        if first_byte is None:
+          first_byte = time.perf_counter() - started
+        wire_bytes += len(chunk)
+  finally:
+    done.set()
+    sampler.join()
+  total = time.perf_counter() - started
+  return {
+    'ttfb_ms': round(first_byte * 1000, 3) if first_byte is not None else None,
+    'seconds': round(total, 4),
+    'wire_mb': round(wire_bytes / 1024 / 1024, 3),
+    'peak_rss_mb': round(peak[0] / 1024, 3),
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Time to first byte and server memory of GET /cars/export by table size')
+  parser.add_argument('--sizes', default='10000,50000,200000', help='comma separated row counts, ascending')
+  parser.add_argument('--formats', default='ndjson,csv,compact')
+  parser.add_argument('--gzip', action='store_true', help='also export every format gzipped')
+  parser.add_argument('--database-url', default=None, help='defaults to BENCH_DATABASE_URL or a SQLite file under benchmarks/results')
+  parser.add_argument('--output', default=None, help='JSON lines file results are appended to')
+  args = parser.parse_args()
+
+  database_url = use_database(args.database_url)
+  variants = [(name, False) for name in args.formats.split(',')]
+  if args.gzip:
+    variants += [(name, True) for name in args.formats.split(',')]
+
+  metrics = {}
+  for size in [int(value) for value in args.sizes.split(',')]:
+    rows = seed_cars(size)
+    # a fresh server per size so the memory numbers start from the same baseline
+    process, base_url = start_api({'DATABASE_URL': database_url})
+    try:
+      idle_mb = round((process_rss_kb(process.pid) or 0) / 1024, 3)
+      metrics[f'rows_{rows}'] = {'idle_rss_mb': idle_mb}
+      for name, compress in variants:
+        label = name + ('_gzip' if compress else '')
+        result = download(base_url, process.pid, {'format': name, 'gzip': compress})
+        result['rss_growth_mb'] = round(result['peak_rss_mb'] - idle_mb, 3)
+        metrics[f'rows_{rows}'][label] = result
+        print(f"{rows} rows {label}: first byte {result['ttfb_ms']} ms, {result['seconds']} s, +{result['rss_growth_mb']} MB")
+    finally:
+      process.terminate()
+      process.wait()
+
+  config = {key: value for key, value in vars(args).items() if key != 'output'}
+  config['database'] = database_url.split(':')[0]
+  record_result('export', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
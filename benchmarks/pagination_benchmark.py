@@ -0,0 +1,49 @@
+# pagination_benchmark.py
+# page latency of GET /cars with offset paging vs. cursor paging at increasing depths
+import os
+import sys
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.common import use_database, seed_cars, time_calls, latency_summary, record_result
+
+def main():
+  parser = argparse.ArgumentParser(description='GET /cars page latency, offset vs. cursor')
+  parser.add_argument('--rows', type=int, default=1_000_000)
+  parser.add_argument('--limit', type=int, default=50)
+  parser.add_argument('--repeat', type=int, default=20)
+  parser.add_argument('--database-url', default=None, help='defaults to a SQLite file under benchmarks/results')
+  parser.add_argument('--output', default=None)
+  args = parser.parse_args()
+
+  url = use_database(args.database_url)
+  rows = seed_cars(args.rows)
+
+  from fastapi.testclient import TestClient
+  # the same page is requested over and over, every request should reach the database
+  os.environ['RESPONSE_CACHE_TTL'] = '0'
+  import webserver
+  client = TestClient(webserver.app)
+
+  depths = sorted({0, 1_000, rows // 10, rows // 2, max(rows - args.limit, 0)})
+  metrics = {}
+  for depth in depths:
+    def offset_page():
+      assert client.get('/cars', params={'limit': args.limit, 'offset': depth}).status_code == 200
+    # ids are dense in the seeded table, so the row at this depth has id == depth
+    cursor = webserver.encode_cursor({'id': depth})
+    def cursor_page():
+      assert client.get('/cars', params={'limit': args.limit, 'cursor': cursor}).status_code == 200
+    metrics[f'depth_{depth}'] = {
+      'offset': latency_summary(time_calls(offset_page, args.repeat)),
+      'cursor': latency_summary(time_calls(cursor_page, args.repeat)),
+    }
+    print(f"depth {depth}: offset p50 {metrics[f'depth_{depth}']['offset']['p50_ms']} ms, cursor p50 {metrics[f'depth_{depth}']['cursor']['p50_ms']} ms")
+
+  config = {'rows': rows, 'limit': args.limit, 'repeat': args.repeat, 'database': url.split(':')[0]}
+  record_result('pagination', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
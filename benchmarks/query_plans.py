@@ -0,0 +1,102 @@
+# query_plans.py
+# checks that every GET /cars filter + sort combination is planned as an index scan, not a full table scan
+import re
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.common import use_database, seed_cars
+
+def plan_cases(encode_cursor, decode_cursor):
+  # cars_query takes decoded cursors, these go through the same encode/decode a client's cursor does
+  def position(values):
+    return decode_cursor(encode_cursor(values), values.get('s', 'id'))
+
+  now = datetime.utcnow()
+  return {
+    'default order': {},
+    'id descending': {'sort': '-id'},
+    'id cursor': {'position': position({'id': 5000})},
+    'price range sorted by price': {'sort': 'price_mdl', 'price_min': 120000, 'price_max': 130000},
+    'price descending with cursor': {'sort': '-price_mdl', 'position': position({'s': 'price_mdl', 'v': 150000.0, 'id': 10})},
+    'colors sorted by price': {'sort': 'price_mdl', 'colors': ['Roșu', 'Verde']},
+    'colors in price range': {'colors': ['Albastru'], 'price_min': 100000, 'price_max': 110000},
+    'kilometrage cap sorted by kilometrage': {'sort': 'kilometrage', 'kilometrage_max': 50000},
+    'created window newest first': {'sort': '-created_at', 'created_after': now - timedelta(days=7), 'created_before': now},
+    'created_at cursor': {'sort': 'created_at', 'position': position({'s': 'created_at', 'v': (now - timedelta(days=30)).isoformat(), 'id': 10})},
+    # the NULLS LAST tail of a sorted listing, read once the rows with a value run out
+    'kilometrage nulls': {'sort': 'kilometrage', 'nulls': True},
+    'kilometrage nulls descending with cursor': {'sort': '-kilometrage', 'nulls': True, 'position': position({'s': 'kilometrage', 'v': None, 'id': 5000})},
+    'price nulls in a color': {'sort': 'price_mdl', 'nulls': True, 'colors': ['Verde']},
+  }
+
+def explain(db, query):
+  compiled = query.compile(dialect=db.get_bind().dialect, compile_kwargs={'render_postcompile': True})
+  params = compiled.params
+  connection = db.connection()
+  if db.get_bind().dialect.name == 'postgresql':
+    row = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + compiled.string, params).scalar()
+    return row if isinstance(row, list) else json.loads(row)
+  positional = tuple(params[name] for name in compiled.positiontup)
+  return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + compiled.string, positional)]
+
+def postgres_problems(plan):
+  problems = []
+  def walk(node):
+    if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') == 'cars':
+      problems.append('Seq Scan on cars')
+    for child in node.get('Plans', []):
+      walk(child)
+  walk(plan[0]['Plan'])
+  return problems
+
+def sqlite_problems(plan, filtered):
+  # a bare rowid scan is already in id order and stops at the limit, it only hurts once rows get filtered out
+  # or the whole table has to be sorted, a temp sort after an index search only sorts the narrowed range
+  scans = [line for line in plan if re.fullmatch(r'SCAN (TABLE )?cars', line.strip())]
+  sorted_in_memory = any('USE TEMP B-TREE FOR ORDER BY' in line for line in plan)
+  if scans and (filtered or sorted_in_memory):
+    return [f'full table scan: {line}' for line in scans]
+  return []
+
+def main():
+  parser = argparse.ArgumentParser(description='Assert GET /cars queries stay index scans')
+  parser.add_argument('--rows', type=int, default=100_000, help='rows seeded so the planner sees a realistic table')
+  parser.add_argument('--database-url', default=None, help='defaults to a SQLite file under benchmarks/results')
+  args = parser.parse_args()
+
+  use_database(args.database_url)
+  seed_cars(args.rows)
+
+  import webserver
+  from database import Session
+
+  db = Session()
+  postgres = db.get_bind().dialect.name == 'postgresql'
+  db.connection().exec_driver_sql('ANALYZE')
+  failures = 0
+  try:
+    for label, filters in plan_cases(webserver.encode_cursor, webserver.decode_cursor).items():
+      query = webserver.cars_query(50, **filters)
+      plan = explain(db, query)
+      filtered = any(key not in ('sort', 'position') for key in filters)
+      problems = postgres_problems(plan) if postgres else sqlite_problems(plan, filtered)
+      failures += bool(problems)
+      print(f"{'FAIL' if problems else 'ok  '} {label}")
+      for line in (problems or []):
+        print(f'       {line}')
+      if problems or not postgres:
+        for line in (json.dumps(plan, indent=2).splitlines() if postgres else plan):
+          print(f'       | {line}')
+  finally:
+    db.close()
+
+  print(f'{failures} of {len(plan_cases(webserver.encode_cursor, webserver.decode_cursor))} queries fall back to a full scan' if failures else 'all queries use indexes')
+  sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,134 @@
+# scraper_benchmark.py
+# drives the scraper end to end against the local stand-in site, no request leaves the machine
+import os
+import sys
+import time
+import argparse
+import resource
+import tracemalloc
+import importlib.util
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.common import latency_summary, record_result
+from benchmarks.stand_in_server import StandInSite, StandInServer
+
+def load_scraper(site_url, args):
+  # web-scraper.py is configured through env vars read at import time
+  os.environ['SCRAPER_SITE'] = site_url
+  os.environ['SCRAPER_CONCURRENCY'] = str(args.concurrency)
+  os.environ['SCRAPER_RATE_LIMIT'] = str(args.rate_limit)
+  os.environ['SCRAPER_CACHE_DIR'] = args.cache_dir or ''
+  if args.extractor:
+    os.environ['SCRAPER_EXTRACTOR'] = args.extractor
+  spec = importlib.util.spec_from_file_location('web_scraper', ROOT / 'web-scraper.py')
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def run(args):
+  site = StandInSite(
+    ads_per_page=args.ads_per_page,
+    pages=args.pages,
+    latency_ms=args.latency_ms,
+    jitter_ms=args.jitter_ms,
+    redirects=args.redirects,
+    chunked=args.chunked,
+    compress=args.gzip,
+  )
+  with StandInServer(site) as server:
+    scraper = load_scraper(server.url, args)
+    scraper.pool.context = server.client_context()
+    listing_urls = [f'{scraper.url}?page={page}' for page in range(1, args.pages + 1)]
+
+    tracemalloc.start()
+
+    # sequential fetches of every listing page and a sample of detail pages
+    fetch_latencies = []
+    for page_url in listing_urls + [f'{server.url}/ro/{i}' for i in range(args.detail_samples)]:
+      started = time.perf_counter()
+      if scraper.fetch_page_socket(page_url) is None:
+        raise RuntimeError(f'fetch failed: {page_url}')
+      fetch_latencies.append(time.perf_counter() - started)
+
+    # detail fetch + color parse latency as seen by the concurrent workers
+    detail_latencies = []
+    extract_additional_info = scraper.extract_additional_info
+    def timed_extract(link):
+      started = time.perf_counter()
+      try:
+        return extract_additional_info(link)
+      finally:
+        detail_latencies.append(time.perf_counter() - started)
+    scraper.extract_additional_info = timed_extract
+
+    listing_parse_times = []
+    products = []
+    started = time.perf_counter()
+    for page_url in listing_urls:
+      html_content = scraper.fetch_page_socket(page_url)
+      parse_started = time.perf_counter()
+      items, _ = scraper.extractor.parse_listing(html_content)
+      listing_parse_times.append(time.perf_counter() - parse_started)
+      products.extend(scraper.build_products(items))
+    crawl_seconds = time.perf_counter() - started
+
+    process_started = time.perf_counter()
+    processed = scraper.process_products(products)
+    process_seconds = time.perf_counter() - process_started
+
+    detail_html = [path.read_text(encoding='utf-8') for path in sorted((ROOT / 'fixtures').glob('detail_*.html'))]
+    color_parse_times = []
+    for html_content in detail_html * 25:
+      parse_started = time.perf_counter()
+      scraper.extractor.parse_color(html_content)
+      color_parse_times.append(time.perf_counter() - parse_started)
+
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+  # ads outside the price window are never fetched, their color stays empty on purpose
+  missing_colors = sum(1 for p in products if p['link'] and p['color'] is None and scraper.in_price_window(p))
+  return {
+    'pages': args.pages,
+    'ads': len(products),
+    'ads_kept': len(processed['products_filtered']),
+    'missing_colors': missing_colors,
+    'requests_served': site.requests,
+    'crawl_seconds': round(crawl_seconds, 4),
+    'pages_per_sec': round(args.pages / crawl_seconds, 3),
+    'ads_per_sec': round(len(products) / crawl_seconds, 3),
+    'fetch_latency': latency_summary(fetch_latencies),
+    'detail_latency': latency_summary(detail_latencies),
+    'listing_parse_ms_per_page': round(sum(listing_parse_times) / len(listing_parse_times) * 1000, 3),
+    'detail_parse_ms_per_page': round(sum(color_parse_times) / len(color_parse_times) * 1000, 3),
+    'process_products_ms': round(process_seconds * 1000, 3),
+    'peak_traced_mb': round(peak_bytes / 1024 / 1024, 3),
+    'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3),
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description='Offline scraper benchmark against a local HTTPS stand-in for 999.md')
+  parser.add_argument('--pages', type=int, default=5)
+  parser.add_argument('--ads-per-page', type=int, default=60)
+  parser.add_argument('--latency-ms', type=float, default=20, help='server delay added to every response')
+  parser.add_argument('--jitter-ms', type=float, default=10, help='random extra delay up to this much')
+  parser.add_argument('--redirects', action='store_true', help='answer every first request with a 302')
+  parser.add_argument('--chunked', action='store_true', help='send bodies with chunked transfer encoding')
+  parser.add_argument('--gzip', action='store_true', help='gzip bodies when the client accepts it')
+  parser.add_argument('--concurrency', type=int, default=8)
+  parser.add_argument('--rate-limit', type=float, default=0, help='per-host requests/sec, 0 disables it')
+  parser.add_argument('--extractor', default=None, help='extraction backend, see extractors.py')
+  parser.add_argument('--cache-dir', default=None, help='enable the page cache in this directory')
+  parser.add_argument('--detail-samples', type=int, default=50)
+  parser.add_argument('--output', default=None, help='JSON lines file results are appended to')
+  args = parser.parse_args()
+
+  config = {key: value for key, value in vars(args).items() if key != 'output'}
+  metrics = run(args)
+  record_result('scraper', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,73 @@
+# search_benchmark.py
+# GET /cars/search latency by table size, first pages and cursor follow-ups for a mix of queries
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.common import latency_summary, record_result, seed_cars, start_api, time_calls, use_database
+
+QUERIES = ['Passat 2010', 'bmw x5', 'golf', 'toyota 201', 'Mercedes E-Class 2005', 'logan 2023', 'octavia skoda 2019', 'tesla']
+
+def main():
+  parser = argparse.ArgumentParser(description='GET /cars/search latency by table size')
+  parser.add_argument('--sizes', default='100000,1000000', help='comma separated row counts, ascending')
+  parser.add_argument('--requests', type=int, default=50, help='timed requests per query and page')
+  parser.add_argument('--limit', type=int, default=20)
+  parser.add_argument('--database-url', default=None, help='defaults to BENCH_DATABASE_URL or a SQLite file under benchmarks/results')
+  parser.add_argument('--output', default=None, help='JSON lines file results are appended to')
+  args = parser.parse_args()
+
+  database_url = use_database(args.database_url)
+  metrics = {}
+  for size in [int(value) for value in args.sizes.split(',')]:
+    rows = seed_cars(size)
+    process, base_url = start_api({'DATABASE_URL': database_url})
+    try:
+      session = requests.Session()
+      # the first search pays for building the in-process index when there is one
+      started = time.perf_counter()
+      session.get(base_url + '/cars/search', params={'q': QUERIES[0]}).raise_for_status()
+      metrics[f'rows_{rows}'] = {'first_search_ms': round((time.perf_counter() - started) * 1000, 3)}
+
+      everything = []
+      for query in QUERIES:
+        params = {'q': query, 'limit': args.limit}
+        first = session.get(base_url + '/cars/search', params=params)
+        first.raise_for_status()
+        words = query.lower().split()
+        for car in first.json():
+          if not all(word in car['name'].lower() for word in words):
+            raise RuntimeError(f"{car['name']!r} doesn't match {query!r}")
+        result = {'results': len(first.json())}
+
+        latencies = time_calls(lambda: session.get(base_url + '/cars/search', params=params).raise_for_status(), args.requests)
+        result['first_page'] = latency_summary(latencies)
+        everything += latencies
+        cursor = first.headers.get('X-Next-Cursor')
+        if cursor:
+          # a page deep enough that it starts inside a run of equally ranked names
+          for _ in range(4):
+            cursor = session.get(base_url + '/cars/search', params={**params, 'cursor': cursor}).headers.get('X-Next-Cursor') or cursor
+          latencies = time_calls(lambda: session.get(base_url + '/cars/search', params={**params, 'cursor': cursor}).raise_for_status(), args.requests)
+          result['fifth_page'] = latency_summary(latencies)
+          everything += latencies
+        metrics[f'rows_{rows}'][query] = result
+        print(f"{rows} rows {query!r}: {result['results']} results, first page p50 {result['first_page']['p50_ms']} ms")
+      metrics[f'rows_{rows}']['all'] = latency_summary(everything)
+      print(f"{rows} rows: all searches p50 {metrics[f'rows_{rows}']['all']['p50_ms']} ms, p99 {metrics[f'rows_{rows}']['all']['p99_ms']} ms")
+    finally:
+      process.terminate()
+      process.wait()
+
+  config = {key: value for key, value in vars(args).items() if key != 'output'}
+  config['database'] = database_url.split(':')[0]
+  record_result('search', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,134 @@
+# stand_in_server.py
+# local HTTPS stand-in for 999.md that serves the recorded pages in fixtures/
+import re
+import ssl
+import socket
+import gzip
+import time
+import random
+import threading
+import subprocess
+import tempfile
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / 'fixtures'
+
+def make_certificate(directory):
+  # self-signed localhost certificate, the benchmark client trusts it explicitly
+  cert = Path(directory) / 'cert.pem'
+  key = Path(directory) / 'key.pem'
+  subprocess.run([
+    'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+    '-keyout', str(key), '-out', str(cert), '-days', '1',
+    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+  ], check=True, capture_output=True)
+  return cert, key
+
+def build_listing(template, ads_per_page, page):
+  # repeats the recorded ads until the page holds ads_per_page of them, each with its own id
+  match = re.search(r'(<ul class="ads-list-photo[^"]*">)(.*?)(</ul>)', template, re.S)
+  ads = re.findall(r'<li class="ads-list-photo-item[^"]*".*?</li>', match.group(2), re.S)
+  ads = [ad for ad in ads if '/ro/' in ad]
+  items = []
+  for i in range(ads_per_page):
+    ad_id = page * 100000 + i
+    items.append(re.sub(r'/ro/\d+', f'/ro/{ad_id}', ads[i % len(ads)]))
+  return template[:match.start(2)] + '\n'.join(items) + template[match.end(2):]
+
+class StandInSite:
+  def __init__(self, ads_per_page=60, pages=5, latency_ms=0, jitter_ms=0, redirects=False, chunked=False, chunk_size=8192, compress=False):
+    listing = (FIXTURES_DIR / 'listing.html').read_text(encoding='utf-8')
+    self.listings = {page: build_listing(listing, ads_per_page, page).encode() for page in range(1, pages + 1)}
+    self.details = [path.read_bytes() for path in sorted(FIXTURES_DIR.glob('detail_*.html'))]
+    self.latency = latency_ms / 1000
+    self.jitter = jitter_ms / 1000
+    self.redirects = redirects
+    self.chunked = chunked
+    self.chunk_size = chunk_size
+    self.compress = compress
+    self.requests = 0
+    self.lock = threading.Lock()
+
+  def page_for(self, path):
+    # returns (status, body or redirect location)
+    route, _, query = path.partition('?')
+    if self.redirects and 'r=1' not in query:
+      return 302, route + ('?' + query + '&' if query else '?') + 'r=1'
+    if route == '/ro/list/transport/cars':
+      page = int(re.search(r'page=(\d+)', query).group(1)) if 'page=' in query else 1
+      return (200, self.listings[page]) if page in self.listings else (404, b'')
+    ad = re.fullmatch(r'/ro/(\d+)', route)
+    if ad:
+      return 200, self.details[int(ad.group(1)) % len(self.details)]
+    return 404, b''
+
+def make_handler(site):
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+      super().setup()
+      # headers and body go out in separate writes, don't let Nagle hold the body back
+      self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+      pass
+
+    def do_GET(self):
+      with site.lock:
+        site.requests += 1
+      if site.latency or site.jitter:
+        time.sleep(site.latency + random.uniform(0, site.jitter))
+
+      status, body = site.page_for(self.path)
+      if status in (301, 302):
+        self.send_response(status)
+        self.send_header('Location', body)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+
+      self.send_response(status)
+      self.send_header('Content-Type', 'text/html; charset=utf-8')
+      if site.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+        body = gzip.compress(body, compresslevel=6)
+        self.send_header('Content-Encoding', 'gzip')
+      if site.chunked:
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(body), site.chunk_size):
+          chunk = body[i:i + site.chunk_size]
+          self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+      else:
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+  return Handler
+
+class StandInServer:
+  # runs the stand-in site on a background thread, use as a context manager
+  def __init__(self, site, host='localhost', port=0):
+    self.site = site
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.cert, key = make_certificate(self.tmp_dir.name)
+    self.httpd = ThreadingHTTPServer((host, port), make_handler(site))
+    self.httpd.daemon_threads = True
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(self.cert, key)
+    self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+    self.url = f'https://{host}:{self.httpd.server_address[1]}'
+
+  def client_context(self):
+    return ssl.create_default_context(cafile=str(self.cert))
+
+  def __enter__(self):
+    threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *exc):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+    self.tmp_dir.cleanup()
@@ -0,0 +1,75 @@
+# stats_benchmark.py
+# GET /cars/stats latency as the table grows, next to the full-scan queries it replaces
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.common import latency_summary, record_result, seed_cars, start_api, time_calls, use_database
+
+def full_scan_stats():
+  # what a dashboard had to do before car_stats: aggregate over every row per request
+  from sqlalchemy import Integer, cast, func
+  from database import Session, Car
+
+  db = Session()
+  try:
+    db.query(func.count(Car.id), func.count(Car.price_mdl), func.sum(Car.price_mdl)).one()
+    db.query(Car.color, func.count(Car.id), func.avg(Car.price_mdl)).group_by(Car.color).all()
+    bucket = cast(Car.kilometrage / 10000, Integer)
+    db.query(bucket, func.count(Car.id)).group_by(bucket).all()
+    prices = db.query(Car.price_mdl).filter(Car.price_mdl.isnot(None)).order_by(Car.price_mdl).all()
+    return len(prices)
+  finally:
+    db.close()
+
+def main():
+  parser = argparse.ArgumentParser(description='GET /cars/stats latency by table size')
+  parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated row counts, ascending')
+  parser.add_argument('--requests', type=int, default=200, help='stats requests timed per size')
+  parser.add_argument('--full-scan-repeat', type=int, default=5)
+  parser.add_argument('--database-url', default=None, help='defaults to BENCH_DATABASE_URL or a SQLite file under benchmarks/results')
+  parser.add_argument('--output', default=None, help='JSON lines file results are appended to')
+  args = parser.parse_args()
+
+  database_url = use_database(args.database_url)
+  metrics = {}
+  for size in [int(value) for value in args.sizes.split(',')]:
+    started = time.perf_counter()
+    before = seed_cars(0)
+    rows = seed_cars(size)
+    seeded = rows - before
+    # seeding goes through the stats triggers like any other insert
+    seed_rate = round(seeded / (time.perf_counter() - started), 1) if seeded else None
+
+    process, base_url = start_api({'DATABASE_URL': database_url})
+    try:
+      session = requests.Session()
+      stats = session.get(base_url + '/cars/stats').json()
+      if stats['cars'] != rows:
+        raise RuntimeError(f"car_stats counts {stats['cars']} cars, the table has {rows}")
+      latencies = time_calls(lambda: session.get(base_url + '/cars/stats').raise_for_status(), args.requests)
+    finally:
+      process.terminate()
+      process.wait()
+
+    full_scan = time_calls(full_scan_stats, args.full_scan_repeat)
+    metrics[f'rows_{rows}'] = {
+      'stats_latency': latency_summary(latencies),
+      'full_scan_latency': latency_summary(full_scan),
+      'seeded_rows_per_sec': seed_rate,
+    }
+    print(f"{rows} rows: stats p50 {metrics[f'rows_{rows}']['stats_latency']['p50_ms']} ms, "
+          f"full scan p50 {metrics[f'rows_{rows}']['full_scan_latency']['p50_ms']} ms")
+
+  config = {key: value for key, value in vars(args).items() if key != 'output'}
+  config['database'] = database_url.split(':')[0]
+  record_result('stats', config, metrics, args.output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,100 @@
+# car_export.py
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from sqlalchemy import select
+from database import Car, session_scope
+from serializers.compact_serializer import CompactSerialize
+
+EXPORT_COLUMNS = ('id', 'name', 'price_mdl', 'link', 'kilometrage', 'color', 'created_at', 'updated_at')
+# rows fetched from the server-side cursor and encoded per chunk
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+def record(row):
+  return {column: value.isoformat() if isinstance(value, datetime) else value for column, value in zip(EXPORT_COLUMNS, row)}
+
+class NDJSONFormat:
+  media_type = 'application/x-ndjson'
+  extension = 'ndjson'
+
+  def header(self):
+    return ''
+
+  def rows(self, rows):
+    return ''.join(json.dumps(record(row), ensure_ascii=False, separators=(',', ':')) + '\n' for row in rows)
+
+  def footer(self):
+    return ''
+
+class CSVFormat:
+  media_type = 'text/csv'
+  extension = 'csv'
+
+  def __init__(self):
+    self.buffer = io.StringIO()
+    self.writer = csv.writer(self.buffer)
+
+  def drain(self):
+    text = self.buffer.getvalue()
+    self.buffer.seek(0)
+    self.buffer.truncate()
+    return text
+
+  def header(self):
+    self.writer.writerow(EXPORT_COLUMNS)
+    return self.drain()
+
+  def rows(self, rows):
+    self.writer.writerows([value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows)
+    return self.drain()
+
+  def footer(self):
+    return ''
+
+class CompactFormat:
+  # one CompactSerialize list of car dicts, CompactSerialize.deserialize reads the whole export back
+  media_type = 'text/plain'
+  extension = 'compact'
+
+  def header(self):
+    return 'l'
+
+  def rows(self, rows):
+    return ''.join(CompactSerialize.serialize(record(row)) for row in rows)
+
+  def footer(self):
+    return 'e'
+
+EXPORT_FORMATS = {
+  'ndjson': NDJSONFormat,
+  'csv': CSVFormat,
+  'compact': CompactFormat,
+}
+
+async def export_cars(format_name, compress=False, batch_size=EXPORT_BATCH_SIZE):
+  # yields the encoded table in id order, one server-side cursor batch at a time
+  # opens its own session because the response body outlives the request handler
+  encoder = EXPORT_FORMATS[format_name]()
+  gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+  def output(text, final=False):
+    data = text.encode()
+    if gzip is not None:
+      # sync flush after every batch so the client can decode as rows arrive
+      data = gzip.compress(data) + gzip.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return data
+
+  data = output(encoder.header())
+  if data:
+    yield data
+  statement = select(*[getattr(Car, column) for column in EXPORT_COLUMNS]).order_by(Car.id).execution_options(yield_per=batch_size)
+  async with session_scope() as db:
+    result = await db.stream(statement)
+    async for rows in result.partitions():
+      yield output(encoder.rows(rows))
+  data = output(encoder.footer(), final=True)
+  if data:
+    yield data
@@ -0,0 +1,22 @@
+# car_schema.py
+# the car as the API returns it, shared with the writers outside the API that publish change feed events
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+
+class CarResponse(BaseModel):
+  id: int
+  name: str
+  price_mdl: float
+  link: str
+  kilometrage: Optional[int]
+  color: Optional[str]
+  created_at: datetime
+  updated_at: datetime
+
+  class Config:
+    from_attributes = True
+
+def car_event(car):
+  # the car of a change feed event, a Car row or a dict of its columns, serialized like GET /cars/{id}
+  return CarResponse.model_validate(car).model_dump(mode='json')
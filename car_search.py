@@ -0,0 +1,233 @@
+# car_search.py
+# word matching and trigram ranking over Car.name for GET /cars/search
+# postgres ranks the distinct names in car_search_names with a pg_trgm GiST index, other databases use the in-process NameIndex below
+import heapq
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import repeat
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, text
+
+# serializes the one-time install when several API nodes start at once
+SEARCH_LOCK_KEY = 18082
+# car_search_log entries kept for NameIndex copies in other processes, one that falls further behind rebuilds
+SEARCH_LOG_KEEP = int(os.getenv('SEARCH_LOG_KEEP', '100000'))
+
+metadata = MetaData()
+
+# name changes of cars, filled by sqlite triggers so every process can bring its NameIndex up to date
+# old_name is empty for inserts, new_name for deletes
+search_log = Table(
+  'car_search_log', metadata,
+  Column('seq', Integer, primary_key=True),
+  Column('car_id', Integer, nullable=False),
+  Column('old_name', String),
+  Column('new_name', String),
+  sqlite_autoincrement=True,
+)
+
+# postgres only: the distinct names of cars with how many carry each, kept current by triggers
+# listings repeat the same names thousands of times, a nearest-first walk over cars would read every copy
+search_names = Table(
+  'car_search_names', metadata,
+  Column('name', String, primary_key=True),
+  Column('cars', Integer, nullable=False),
+)
+
+def search_words(value):
+  # lowercased runs of letters and digits, the same split pg_trgm makes
+  return re.findall(r'[^\W_]+', value.lower()) if value else []
+
+def trigrams(value):
+  # pg_trgm's trigrams: every word padded with two spaces in front and one behind
+  grams = set()
+  for word in search_words(value):
+    padded = f'  {word} '
+    grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+  return grams
+
+def similarity(a, b):
+  # pg_trgm similarity() of two trigram sets
+  if not a or not b:
+    return 0.0
+  shared = len(a & b)
+  return shared / (len(a) + len(b) - shared)
+
+def sqlite_trigger_ddl():
+  return [
+    'CREATE TRIGGER IF NOT EXISTS car_search_insert AFTER INSERT ON cars '
+    'BEGIN INSERT INTO car_search_log (car_id, old_name, new_name) VALUES (NEW.id, NULL, NEW.name); END',
+    'CREATE TRIGGER IF NOT EXISTS car_search_update AFTER UPDATE OF name ON cars WHEN OLD.name IS NOT NEW.name '
+    'BEGIN INSERT INTO car_search_log (car_id, old_name, new_name) VALUES (NEW.id, OLD.name, NEW.name); END',
+    'CREATE TRIGGER IF NOT EXISTS car_search_delete AFTER DELETE ON cars '
+    'BEGIN INSERT INTO car_search_log (car_id, old_name, new_name) VALUES (OLD.id, OLD.name, NULL); END',
+  ]
+
+def names_merge_sql(changes):
+  # folds signed (name, sign) rows into car_search_names and drops names no car carries anymore
+  # names are merged in order so concurrent writers lock car_search_names rows in the same order
+  return f"""
+    INSERT INTO car_search_names (name, cars)
+    SELECT name, SUM(sign) FROM ({changes}) AS changes WHERE name IS NOT NULL
+    GROUP BY name HAVING SUM(sign) <> 0
+    ORDER BY name
+    ON CONFLICT (name) DO UPDATE SET cars = car_search_names.cars + excluded.cars;
+    DELETE FROM car_search_names WHERE cars <= 0 AND name IN (SELECT name FROM ({changes}) AS changes)
+  """
+
+def postgres_trigger_ddl():
+  # statement-level triggers over transition tables like car_stats', an update that keeps the name nets to nothing
+  statements = []
+  for event, changes in (
+    ('insert', 'SELECT name, 1 AS sign FROM new_rows'),
+    ('update', 'SELECT name, -1 AS sign FROM old_rows UNION ALL SELECT name, 1 AS sign FROM new_rows'),
+    ('delete', 'SELECT name, -1 AS sign FROM old_rows'),
+  ):
+    statements.append(f"""
+      CREATE OR REPLACE FUNCTION car_search_{event}() RETURNS trigger AS $$
+      BEGIN
+        {names_merge_sql(changes)};
+        RETURN NULL;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    statements.append(f'DROP TRIGGER IF EXISTS car_search_{event} ON cars')
+    referencing = {'insert': 'NEW TABLE AS new_rows', 'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows', 'delete': 'OLD TABLE AS old_rows'}[event]
+    statements.append(f"""
+      CREATE TRIGGER car_search_{event} AFTER {event.upper()} ON cars
+      REFERENCING {referencing} FOR EACH STATEMENT EXECUTE FUNCTION car_search_{event}()
+    """)
+  return statements
+
+def install_search(engine):
+  # car_search_names and its indexes on postgres, the change log and its triggers elsewhere, returns False if already there
+  with engine.begin() as connection:
+    if connection.dialect.name == 'postgresql':
+      connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SEARCH_LOCK_KEY})
+      if inspect(connection).has_table('car_search_names'):
+        return False
+      connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+      search_names.create(connection)
+      # no writes may slip in between the initial scan and the triggers going live
+      connection.exec_driver_sql('LOCK TABLE cars IN SHARE ROW EXCLUSIVE MODE')
+      for statement in postgres_trigger_ddl():
+        connection.exec_driver_sql(statement)
+      connection.exec_driver_sql(names_merge_sql('SELECT name, 1 AS sign FROM cars'))
+      # serves both the ILIKE '%word%' filters and the nearest-first name <-> q order, GIN can't do the latter
+      connection.exec_driver_sql('CREATE INDEX ix_car_search_names_trgm ON car_search_names USING gist (name gist_trgm_ops)')
+      # the cars of each ranked name in id order
+      connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_cars_name_id ON cars (name, id)')
+      # the GIN index earlier versions created, nothing reads it anymore
+      connection.exec_driver_sql('DROP INDEX IF EXISTS ix_cars_name_trgm')
+      return True
+    if inspect(connection).has_table('car_search_log'):
+      return False
+    search_log.create(connection)
+    for statement in sqlite_trigger_ddl():
+      connection.exec_driver_sql(statement)
+    return True
+
+class NameIndex:
+  # word -> distinct names containing it, name -> sorted ids of the cars carrying it
+  # listings repeat the same few thousand names, so ranking scores names rather than rows
+  # built with one scan of cars on first use, then kept current from car_search_log
+  def __init__(self, engine):
+    self.engine = engine
+    self.lock = threading.Lock()
+    self.ids = {}
+    self.words = defaultdict(set)
+    self.seq = None
+    self.pruned = 0
+
+  def add(self, car_id, name):
+    if name is None:
+      return
+    ids = self.ids.get(name)
+    if ids is None:
+      ids = self.ids[name] = array('q')
+      for word in set(search_words(name)):
+        self.words[word].add(name)
+    i = bisect_left(ids, car_id)
+    if i == len(ids) or ids[i] != car_id:
+      ids.insert(i, car_id)
+
+  def remove(self, car_id, name):
+    ids = self.ids.get(name)
+    if ids is None:
+      return
+    i = bisect_left(ids, car_id)
+    if i < len(ids) and ids[i] == car_id:
+      del ids[i]
+    if not ids:
+      del self.ids[name]
+      for word in set(search_words(name)):
+        self.words[word].discard(name)
+        if not self.words[word]:
+          del self.words[word]
+
+  def build(self, connection):
+    # log entries after the position read here are applied on top, replaying one the scan already saw is a no-op
+    self.ids.clear()
+    self.words.clear()
+    self.seq = connection.execute(text('SELECT COALESCE(MAX(seq), 0) FROM car_search_log')).scalar()
+    self.pruned = 0
+    rows = connection.execution_options(yield_per=10000).execute(text('SELECT id, name FROM cars ORDER BY id'))
+    for car_id, name in rows:
+      self.add(car_id, name)
+    print(f'built the car name index: {len(self.ids)} names, {len(self.words)} words')
+
+  def refresh(self):
+    with self.lock, self.engine.connect() as connection:
+      if self.seq is None:
+        self.build(connection)
+      changes = connection.execute(
+        text('SELECT seq, car_id, old_name, new_name FROM car_search_log WHERE seq > :seq ORDER BY seq'), {'seq': self.seq}).all()
+      if changes and changes[0].seq != self.seq + 1:
+        # another process pruned entries this copy never saw
+        self.build(connection)
+      else:
+        for seq, car_id, old_name, new_name in changes:
+          self.remove(car_id, old_name)
+          self.add(car_id, new_name)
+          self.seq = seq
+      if self.seq - self.pruned > 2 * SEARCH_LOG_KEEP:
+        connection.execute(text('DELETE FROM car_search_log WHERE seq <= :seq'), {'seq': self.seq - SEARCH_LOG_KEEP})
+        connection.commit()
+        self.pruned = self.seq - SEARCH_LOG_KEEP
+
+  def page(self, query, after=None, count=10):
+    # up to count (score, id, name) matches of every query word, best score first and ids ascending within a score
+    # after is the (score, id) of the last match already returned
+    self.refresh()
+    query_grams = trigrams(query)
+    with self.lock:
+      names = None
+      for term in set(search_words(query)):
+        found = set()
+        for word, word_names in self.words.items():
+          if term in word:
+            found |= word_names
+        names = found if names is None else names & found
+        if not names:
+          return []
+
+      levels = defaultdict(list)
+      for name in names:
+        levels[similarity(query_grams, trigrams(name))].append(name)
+      matches = []
+      for score in sorted(levels, reverse=True):
+        if after is not None and score > after[0]:
+          continue
+        start = after[1] if after is not None and score == after[0] else None
+        runs = []
+        for name in levels[score]:
+          ids = self.ids[name]
+          runs.append(zip(ids[bisect_right(ids, start):] if start is not None else ids, repeat(name)))
+        for car_id, name in heapq.merge(*runs):
+          matches.append((score, car_id, name))
+          if len(matches) == count:
+            return matches
+      return matches
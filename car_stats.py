@@ -0,0 +1,175 @@
+# car_stats.py
+# running aggregates of the cars table, kept current by database triggers so GET /cars/stats never scans cars
+from collections import defaultdict
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, inspect, select, text
+
+# histogram bucket widths, they are baked into the triggers, changing them needs rebuild_stats
+PRICE_BUCKET_MDL = 5000
+KILOMETRAGE_BUCKET_KM = 10000
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+# serializes the one-time install when several API nodes start at once
+STATS_LOCK_KEY = 18081
+
+metadata = MetaData()
+
+# one row per (dimension, key): ('total', ''), ('color', color), ('price', bucket), ('kilometrage', bucket)
+# an empty key is a missing value, cars with a price are counted in priced
+car_stats = Table(
+  'car_stats', metadata,
+  Column('dimension', String, primary_key=True),
+  Column('key', String, primary_key=True),
+  Column('cars', Integer, nullable=False, default=0),
+  Column('priced', Integer, nullable=False, default=0),
+  Column('price_sum', Float, nullable=False, default=0.0),
+)
+
+def bucket_sql(column, width):
+  return f"CASE WHEN {column} IS NULL THEN '' ELSE CAST(CAST(FLOOR({column} / {width}.0) AS BIGINT) AS VARCHAR) END"
+
+def sqlite_bucket_sql(column, width):
+  # no FLOOR in stock sqlite, truncation is the same for the non-negative values stored here
+  return f"CASE WHEN {column} IS NULL THEN '' ELSE CAST(CAST({column} / {width}.0 AS INTEGER) AS TEXT) END"
+
+def merge_sql(changes, dialect):
+  # folds signed (color, price_mdl, kilometrage, sign) rows into car_stats, one upsert per touched key
+  # plain subqueries rather than a WITH clause, sqlite doesn't allow those inside triggers
+  bucket = sqlite_bucket_sql if dialect == 'sqlite' else bucket_sql
+  keyed = ' UNION ALL '.join(
+    f"SELECT '{dimension}' AS dimension, {key} AS key, sign, price_mdl FROM ({changes}) AS changes"
+    for dimension, key in (
+      ('total', "''"),
+      ('color', "COALESCE(color, '')"),
+      ('price', bucket('price_mdl', PRICE_BUCKET_MDL)),
+      ('kilometrage', bucket('kilometrage', KILOMETRAGE_BUCKET_KM)),
+    ))
+  return f"""
+    INSERT INTO car_stats (dimension, key, cars, priced, price_sum)
+    SELECT dimension, key, SUM(sign), SUM(CASE WHEN price_mdl IS NULL THEN 0 ELSE sign END), COALESCE(SUM(sign * price_mdl), 0)
+    FROM ({keyed}) AS keyed WHERE true
+    GROUP BY dimension, key
+    ORDER BY dimension, key
+    ON CONFLICT (dimension, key) DO UPDATE SET
+      cars = car_stats.cars + excluded.cars,
+      priced = car_stats.priced + excluded.priced,
+      price_sum = car_stats.price_sum + excluded.price_sum
+  """
+
+def changes_sql(source, sign):
+  return f'SELECT color, price_mdl, kilometrage, {sign} AS sign FROM {source}'
+
+def postgres_trigger_ddl():
+  # statement-level triggers over transition tables, a bulk upsert of 1000 rows is one merge, not 1000
+  # keys are merged in order so concurrent writers lock car_stats rows in the same order
+  statements = []
+  for event, changes in (
+    ('insert', changes_sql('new_rows', 1)),
+    ('update', changes_sql('old_rows', -1) + ' UNION ALL ' + changes_sql('new_rows', 1)),
+    ('delete', changes_sql('old_rows', -1)),
+  ):
+    statements.append(f"""
+      CREATE OR REPLACE FUNCTION car_stats_{event}() RETURNS trigger AS $$
+      BEGIN
+        {merge_sql(changes, 'postgresql')};
+        RETURN NULL;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    statements.append(f'DROP TRIGGER IF EXISTS car_stats_{event} ON cars')
+    referencing = {'insert': 'NEW TABLE AS new_rows', 'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows', 'delete': 'OLD TABLE AS old_rows'}[event]
+    statements.append(f"""
+      CREATE TRIGGER car_stats_{event} AFTER {event.upper()} ON cars
+      REFERENCING {referencing} FOR EACH STATEMENT EXECUTE FUNCTION car_stats_{event}()
+    """)
+  return statements
+
+def sqlite_trigger_ddl():
+  # sqlite only has row triggers, each one merges the row it fired for
+  def row_merge(row, sign):
+    return merge_sql(f'SELECT {row}.color AS color, {row}.price_mdl AS price_mdl, {row}.kilometrage AS kilometrage, {sign} AS sign', 'sqlite')
+  return [
+    f'CREATE TRIGGER IF NOT EXISTS car_stats_insert AFTER INSERT ON cars BEGIN {row_merge("NEW", 1)}; END',
+    f'CREATE TRIGGER IF NOT EXISTS car_stats_update AFTER UPDATE OF color, price_mdl, kilometrage ON cars BEGIN {row_merge("OLD", -1)}; {row_merge("NEW", 1)}; END',
+    f'CREATE TRIGGER IF NOT EXISTS car_stats_delete AFTER DELETE ON cars BEGIN {row_merge("OLD", -1)}; END',
+  ]
+
+def rebuild_stats(connection):
+  # recomputes car_stats with one scan of cars, the triggers keep it current from then on
+  connection.execute(car_stats.delete())
+  connection.exec_driver_sql(merge_sql(changes_sql('cars', 1), connection.dialect.name))
+
+def install_stats(engine):
+  # creates car_stats, its triggers and the initial totals in one transaction, returns False if already there
+  with engine.begin() as connection:
+    postgres = connection.dialect.name == 'postgresql'
+    if postgres:
+      connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': STATS_LOCK_KEY})
+    if inspect(connection).has_table('car_stats'):
+      return False
+    metadata.create_all(connection)
+    if postgres:
+      # no writes may slip in between the initial scan and the triggers going live
+      connection.exec_driver_sql('LOCK TABLE cars IN SHARE ROW EXCLUSIVE MODE')
+    for statement in postgres_trigger_ddl() if postgres else sqlite_trigger_ddl():
+      connection.exec_driver_sql(statement)
+    rebuild_stats(connection)
+    return True
+
+def bucket_percentiles(buckets, width):
+  # buckets are sorted (index, count), values are interpolated linearly inside their bucket
+  total = sum(count for _, count in buckets)
+  percentiles = {}
+  for pct in PERCENTILES:
+    target = total * pct / 100
+    seen = 0
+    for index, count in buckets:
+      if seen + count >= target:
+        percentiles[f'p{pct}'] = round((index + (target - seen) / count) * width, 2)
+        break
+      seen += count
+  return percentiles
+
+def histogram(buckets, width):
+  return [{'from': index * width, 'to': (index + 1) * width, 'cars': count} for index, count in buckets]
+
+def summarize(rows):
+  dimensions = defaultdict(dict)
+  for row in rows:
+    if row.cars:
+      dimensions[row.dimension][row.key] = row
+  total = dimensions['total'].get('')
+  cars = total.cars if total else 0
+  priced = total.priced if total else 0
+  price_sum = total.price_sum if total else 0.0
+
+  price_buckets = sorted((int(key), row.cars) for key, row in dimensions['price'].items() if key != '')
+  km_buckets = sorted((int(key), row.cars) for key, row in dimensions['kilometrage'].items() if key != '')
+  unknown_km = dimensions['kilometrage'].get('')
+  colors = sorted(dimensions['color'].values(), key=lambda row: (-row.cars, row.key))
+
+  return {
+    'cars': cars,
+    'price_mdl': {
+      'count': priced,
+      'total': round(price_sum, 2),
+      'mean': round(price_sum / priced, 2) if priced else None,
+      # approximate, exact to within one bucket
+      'percentiles': bucket_percentiles(price_buckets, PRICE_BUCKET_MDL),
+      'bucket_width': PRICE_BUCKET_MDL,
+      'histogram': histogram(price_buckets, PRICE_BUCKET_MDL),
+    },
+    'colors': [{
+      'color': row.key or None,
+      'cars': row.cars,
+      'share': round(row.cars / cars, 4) if cars else 0.0,
+      'mean_price_mdl': round(row.price_sum / row.priced, 2) if row.priced else None,
+    } for row in colors],
+    'kilometrage': {
+      'known': sum(count for _, count in km_buckets),
+      'unknown': unknown_km.cars if unknown_km else 0,
+      'bucket_width': KILOMETRAGE_BUCKET_KM,
+      'histogram': histogram(km_buckets, KILOMETRAGE_BUCKET_KM),
+    },
+  }
+
+async def read_stats(db):
+  return summarize((await db.execute(select(car_stats))).all())
@@ -0,0 +1,270 @@
+# cluster.py
+# runs every WEB_SERVER_NODES entry as its own process behind a local least-connections balancer
+# the websocket server and, when asked for, the FTP processor run here, once for the whole cluster
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+
+BALANCER_HOST = os.getenv('BALANCER_HOST', 'localhost')
+BALANCER_PORT = int(os.getenv('BALANCER_PORT', '8000'))
+# health checks poll GET /health on every node
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', '2'))
+HEALTH_TIMEOUT = float(os.getenv('HEALTH_TIMEOUT', '1'))
+# consecutive failed checks before a node is taken out, passed checks before it is put back
+HEALTH_FALL = 2
+HEALTH_RISE = 2
+CONNECT_TIMEOUT = 2
+NODE_LOG_LEVEL = os.getenv('NODE_LOG_LEVEL', 'warning')
+# a node that dies this soon after starting is restarted with a growing delay
+RESTART_WINDOW = 10
+MAX_RESTART_DELAY = 30
+
+NO_BACKEND = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+              b'Content-Length: 40\r\nConnection: close\r\n\r\n{"detail": "no healthy web server node"}')
+
+def parse_nodes(value):
+  # 'localhost:8001,localhost:8002' -> [('localhost', 8001), ('localhost', 8002)]
+  nodes = []
+  for item in value.split(','):
+    host, _, port = item.strip().rpartition(':')
+    nodes.append((host or 'localhost', int(port)))
+  return nodes
+
+def run_node(host, port):
+  # entry point of a node process, each one imports the app and owns its own engine and pool
+  import uvicorn
+  uvicorn.run('webserver:app', host=host, port=port, log_level=NODE_LOG_LEVEL)
+
+class Backend:
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    self.active = 0
+    self.served = 0
+    self.healthy = False
+    # the first passed check brings a new node up, after that it takes HEALTH_RISE
+    self.passes = HEALTH_RISE - 1
+    self.failures = 0
+
+  @property
+  def name(self):
+    return f'{self.host}:{self.port}'
+
+  def mark(self, ok):
+    if ok:
+      self.passes += 1
+      self.failures = 0
+      if not self.healthy and self.passes >= HEALTH_RISE:
+        self.healthy = True
+        print(f'balancer: {self.name} is up')
+    else:
+      self.failures += 1
+      self.passes = 0
+      if self.healthy and self.failures >= HEALTH_FALL:
+        self.take_out('failed health checks')
+
+  def take_out(self, reason):
+    if self.healthy:
+      print(f'balancer: {self.name} is down, {reason}')
+    self.healthy = False
+    self.passes = 0
+
+  def stats(self):
+    return {'healthy': self.healthy, 'active': self.active, 'served': self.served}
+
+async def pipe(reader, writer):
+  # returns True on a clean end of stream, False when either side reset the connection
+  try:
+    while True:
+      data = await reader.read(65536)
+      if not data:
+        return True
+      writer.write(data)
+      await writer.drain()
+  except (ConnectionError, OSError):
+    return False
+
+class Balancer:
+  # a TCP proxy, each client connection goes to the healthy node with the fewest open connections
+  # it never parses HTTP, so keep-alive, streamed responses and uploads pass through as they are
+  def __init__(self, backends):
+    self.backends = backends
+    self.turn = 0
+
+  def pick(self, tried):
+    candidates = [backend for backend in self.backends if backend.healthy and backend not in tried]
+    if not candidates:
+      return None
+    fewest = min(backend.active for backend in candidates)
+    tied = [backend for backend in candidates if backend.active == fewest]
+    # ties rotate, otherwise an idle cluster sends everything to the first node
+    self.turn += 1
+    return tied[self.turn % len(tied)]
+
+  async def connect(self):
+    tried = set()
+    while True:
+      backend = self.pick(tried)
+      if backend is None:
+        return None, None, None
+      # counted before the connect so concurrent accepts spread out
+      backend.active += 1
+      try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(backend.host, backend.port), CONNECT_TIMEOUT)
+        return backend, reader, writer
+      except (OSError, asyncio.TimeoutError) as e:
+        backend.active -= 1
+        backend.take_out(f'connect failed: {e!r}')
+        tried.add(backend)
+
+  async def handle(self, client_reader, client_writer):
+    backend, reader, writer = await self.connect()
+    if backend is None:
+      client_writer.write(NO_BACKEND)
+      await client_writer.drain()
+      client_writer.close()
+      return
+    backend.served += 1
+    upstream = asyncio.create_task(pipe(client_reader, writer))
+    downstream = asyncio.create_task(pipe(reader, client_writer))
+    try:
+      # the node closing ends the exchange, the client closing only half-closes towards the node
+      await asyncio.wait({upstream, downstream}, return_when=asyncio.FIRST_COMPLETED)
+      if upstream.done() and upstream.result() and not downstream.done():
+        writer.write_eof()
+        await downstream
+    except (ConnectionError, OSError):
+      pass
+    finally:
+      backend.active -= 1
+      upstream.cancel()
+      downstream.cancel()
+      for stream in (writer, client_writer):
+        stream.close()
+
+  async def check(self, backend):
+    try:
+      reader, writer = await asyncio.wait_for(asyncio.open_connection(backend.host, backend.port), HEALTH_TIMEOUT)
+      try:
+        writer.write(f'GET /health HTTP/1.1\r\nHost: {backend.name}\r\nConnection: close\r\n\r\n'.encode())
+        status_line = await asyncio.wait_for(reader.readline(), HEALTH_TIMEOUT)
+        ok = status_line.split()[1:2] == [b'200']
+      finally:
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+      ok = False
+    backend.mark(ok)
+
+  async def health_checks(self):
+    while True:
+      await asyncio.gather(*(self.check(backend) for backend in self.backends))
+      await asyncio.sleep(HEALTH_INTERVAL)
+
+  def stats(self):
+    return {backend.name: backend.stats() for backend in self.backends}
+
+class Cluster:
+  # starts the node processes and restarts the ones that exit
+  def __init__(self, nodes):
+    self.nodes = nodes
+    # spawn, not fork, nodes must not inherit the launcher's threads and sockets
+    self.context = multiprocessing.get_context('spawn')
+    self.processes = {}
+    self.started = {}
+    self.delays = {}
+    self.stopping = False
+
+  def start_node(self, node):
+    process = self.context.Process(target=run_node, args=node, name=f'web-{node[1]}')
+    process.start()
+    self.processes[node] = process
+    self.started[node] = time.monotonic()
+
+  def start(self):
+    for node in self.nodes:
+      self.start_node(node)
+    print(f"cluster: started {len(self.nodes)} nodes: {', '.join(f'{host}:{port}' for host, port in self.nodes)}")
+
+  async def supervise(self):
+    while not self.stopping:
+      await asyncio.sleep(1)
+      for node, process in list(self.processes.items()):
+        if process is None or process.is_alive() or self.stopping:
+          continue
+        if time.monotonic() - self.started[node] < RESTART_WINDOW:
+          self.delays[node] = min(self.delays.get(node, 0.5) * 2, MAX_RESTART_DELAY)
+        else:
+          self.delays[node] = 1
+        print(f'cluster: node {node[0]}:{node[1]} exited with {process.exitcode}, restarting in {self.delays[node]}s')
+        # parked until the delay runs out
+        self.started[node] = time.monotonic() + self.delays[node]
+        self.processes[node] = None
+      for node, process in list(self.processes.items()):
+        if process is None and time.monotonic() >= self.started[node] and not self.stopping:
+          self.start_node(node)
+
+  def stop(self, timeout=10):
+    # uvicorn finishes in-flight requests on SIGTERM
+    self.stopping = True
+    running = [process for process in self.processes.values() if process is not None]
+    for process in running:
+      process.terminate()
+    deadline = time.monotonic() + timeout
+    for process in running:
+      process.join(max(0, deadline - time.monotonic()))
+      if process.is_alive():
+        process.kill()
+        process.join()
+
+async def run(nodes, ftp=False, websocket=True):
+  cluster = Cluster(nodes)
+  balancer = Balancer([Backend(host, port) for host, port in nodes])
+  tasks = []
+  if websocket:
+    from websocket.websocket_server import server_url, start_server
+    tasks.append(asyncio.create_task(start_server()))
+    # the nodes inherit it and publish their car changes to this server
+    os.environ.setdefault('CHANGE_FEED_URL', server_url())
+  cluster.start()
+  server = await asyncio.start_server(balancer.handle, BALANCER_HOST, BALANCER_PORT)
+  print(f'balancer: listening on http://{BALANCER_HOST}:{BALANCER_PORT}')
+
+  tasks += [asyncio.create_task(balancer.health_checks()), asyncio.create_task(cluster.supervise())]
+  if ftp:
+    from ftp_processor import start_ftp_processor
+    # uploads go through the balancer like any other client
+    start_ftp_processor(webserver_url=f'http://{BALANCER_HOST}:{BALANCER_PORT}/upload/')
+
+  stop = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for sig in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(sig, stop.set)
+  await stop.wait()
+
+  print('cluster: shutting down')
+  server.close()
+  for task in tasks:
+    task.cancel()
+  await loop.run_in_executor(None, cluster.stop)
+  print(f'balancer: {balancer.stats()}')
+
+def main():
+  parser = argparse.ArgumentParser(description='Run the web server nodes behind a local balancer')
+  parser.add_argument('--nodes', default=os.getenv('CLUSTER_NODES'), help='host:port list, defaults to WEB_SERVER_NODES')
+  parser.add_argument('--ftp', action='store_true', default=os.getenv('FTP_PROCESSOR') == '1', help='start the FTP processor, also FTP_PROCESSOR=1')
+  parser.add_argument('--no-websocket', action='store_true', default=os.getenv('WEBSOCKET_SERVER') == '0',
+                      help="don't start the websocket server or the change feed, also WEBSOCKET_SERVER=0")
+  args = parser.parse_args()
+
+  if args.nodes:
+    nodes = parse_nodes(args.nodes)
+  else:
+    from webserver import WEB_SERVER_NODES
+    nodes = list(WEB_SERVER_NODES)
+  asyncio.run(run(nodes, ftp=args.ftp, websocket=not args.no_websocket))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,195 @@
+# extractors.py
+# pluggable HTML extraction backends for the 999.md listing and detail pages
+import os
+import sys
+from pathlib import Path
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
+
+try:
+  from lxml import etree
+except ImportError:
+  etree = None
+
+def join_chunks(html):
+  # backends accept either the whole page or an iterable of text pieces
+  return html if isinstance(html, str) else ''.join(html)
+
+def class_filter(*names):
+  # strainer attribute matcher, class is still the raw attribute string while parsing
+  wanted = set(names)
+  def match(value):
+    if not value:
+      return False
+    classes = value.split() if isinstance(value, str) else value
+    return not wanted.isdisjoint(classes)
+  return match
+
+def best_parser():
+  return 'lxml' if etree is not None else 'html.parser'
+
+class SoupExtractor:
+  # the original full-page BeautifulSoup parse, kept as the fallback and the parity reference
+  name = 'soup'
+
+  def parse_listing(self, html):
+    soup = BeautifulSoup(join_chunks(html), 'html.parser')
+    items = []
+    for element in soup.select('li.ads-list-photo-item'):
+      name_element = element.select_one('div.ads-list-photo-item-title a')
+      price_element = element.select_one('span.ads-list-photo-item-price-wrapper')
+      link_element = element.select_one('div.ads-list-photo-item-title a')
+      kilometrage_element = element.select_one('div.is-offer-type span')
+      items.append({
+        'name': name_element.text if name_element else None,
+        'price': price_element.text if price_element else None,
+        'href': link_element['href'] if link_element else None,
+        'kilometrage': kilometrage_element.text if kilometrage_element else None,
+      })
+    page_links = [a['href'] for a in soup.select('nav.paginator a[href]')]
+    return items, page_links
+
+  def parse_color(self, html):
+    soup = BeautifulSoup(join_chunks(html), 'html.parser')
+    color_element = soup.select_one('li.m-value[itemprop="additionalProperty"] span.adPage__content__features__key:-soup-contains("Culoarea") + span.adPage__content__features__value')
+    return color_element.text.strip() if color_element else None
+
+class StrainedSoupExtractor:
+  # only builds the ad items / feature rows and runs precompiled selectors on them
+  name = 'strained'
+  listing_strainer = SoupStrainer(attrs={'class': class_filter('ads-list-photo-item', 'paginator')})
+  detail_strainer = SoupStrainer('li', attrs={'itemprop': 'additionalProperty'})
+  items_selector = soupsieve.compile('li.ads-list-photo-item')
+  title_selector = soupsieve.compile('div.ads-list-photo-item-title a')
+  price_selector = soupsieve.compile('span.ads-list-photo-item-price-wrapper')
+  kilometrage_selector = soupsieve.compile('div.is-offer-type span')
+  page_links_selector = soupsieve.compile('nav.paginator a[href]')
+  feature_key_selector = soupsieve.compile('li.m-value span.adPage__content__features__key')
+  feature_value_selector = soupsieve.compile('span.adPage__content__features__value')
+
+  def __init__(self, parser=None):
+    self.parser = parser or best_parser()
+
+  def parse_listing(self, html):
+    soup = BeautifulSoup(join_chunks(html), self.parser, parse_only=self.listing_strainer)
+    items = []
+    for element in self.items_selector.select(soup):
+      title_element = self.title_selector.select_one(element)
+      price_element = self.price_selector.select_one(element)
+      kilometrage_element = self.kilometrage_selector.select_one(element)
+      items.append({
+        'name': title_element.text if title_element else None,
+        'price': price_element.text if price_element else None,
+        'href': title_element['href'] if title_element else None,
+        'kilometrage': kilometrage_element.text if kilometrage_element else None,
+      })
+    page_links = [a['href'] for a in self.page_links_selector.select(soup)]
+    return items, page_links
+
+  def parse_color(self, html):
+    soup = BeautifulSoup(join_chunks(html), self.parser, parse_only=self.detail_strainer)
+    for key in self.feature_key_selector.select(soup):
+      if 'Culoarea' not in key.text:
+        continue
+      value = key.find_next_sibling()
+      if value is not None and self.feature_value_selector.match(value):
+        return value.text.strip()
+    return None
+
+def has_class(name):
+  return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+class LxmlExtractor:
+  # lxml tree with precompiled XPath, fed the page incrementally when it arrives in pieces
+  name = 'lxml'
+
+  def __init__(self):
+    if etree is None:
+      raise ImportError('lxml is not installed')
+    self.items = etree.XPath(f'//li[{has_class("ads-list-photo-item")}]')
+    self.title = etree.XPath(f'(.//div[{has_class("ads-list-photo-item-title")}]//a)[1]')
+    self.price = etree.XPath(f'(.//span[{has_class("ads-list-photo-item-price-wrapper")}])[1]')
+    self.kilometrage = etree.XPath(f'(.//div[{has_class("is-offer-type")}]//span)[1]')
+    self.page_links = etree.XPath(f'//nav[{has_class("paginator")}]//a/@href')
+    self.color = etree.XPath(
+      f'(//li[{has_class("m-value")}][@itemprop="additionalProperty"]'
+      f'//span[{has_class("adPage__content__features__key")}][contains(., "Culoarea")]'
+      f'/following-sibling::*[1][self::span][{has_class("adPage__content__features__value")}])[1]'
+    )
+
+  def parse(self, html):
+    parser = etree.HTMLParser()
+    for chunk in ((html,) if isinstance(html, str) else html):
+      parser.feed(chunk)
+    try:
+      return parser.close()
+    except etree.XMLSyntaxError:
+      # nothing parseable was fed, e.g. an empty body
+      return None
+
+  def text(self, matches):
+    return ''.join(matches[0].itertext()) if matches else None
+
+  def parse_listing(self, html):
+    root = self.parse(html)
+    if root is None:
+      return [], []
+    items = []
+    for element in self.items(root):
+      title = self.title(element)
+      items.append({
+        'name': self.text(title),
+        'price': self.text(self.price(element)),
+        'href': title[0].get('href') if title else None,
+        'kilometrage': self.text(self.kilometrage(element)),
+      })
+    return items, [str(href) for href in self.page_links(root)]
+
+  def parse_color(self, html):
+    root = self.parse(html)
+    if root is None:
+      return None
+    color = self.text(self.color(root))
+    return color.strip() if color is not None else None
+
+BACKENDS = {
+  'soup': SoupExtractor,
+  'strained': StrainedSoupExtractor,
+  'lxml': LxmlExtractor,
+}
+
+def get_extractor(name=None):
+  # picks the fastest installed backend unless one is asked for by name
+  name = name or ('lxml' if etree is not None else 'strained')
+  if name not in BACKENDS:
+    raise ValueError(f'Unknown extraction backend: {name}')
+  return BACKENDS[name]()
+
+def available_backends():
+  return [name for name in BACKENDS if name != 'lxml' or etree is not None]
+
+def check_parity(fixtures_dir):
+  # every backend has to extract exactly what the reference BeautifulSoup path does
+  reference = SoupExtractor()
+  backends = [get_extractor(name) for name in available_backends() if name != reference.name]
+  mismatches = 0
+  for path in sorted(Path(fixtures_dir).glob('*.html')):
+    html = path.read_text(encoding='utf-8')
+    parse = 'parse_listing' if path.name.startswith('listing') else 'parse_color'
+    expected = getattr(reference, parse)(html)
+    for backend in backends:
+      # feed the page in small pieces to also cover the incremental path
+      pieces = [html[i:i + 1000] for i in range(0, len(html), 1000)]
+      for source in (html, pieces):
+        actual = getattr(backend, parse)(source)
+        if actual != expected:
+          mismatches += 1
+          print(f'MISMATCH {backend.name} {path.name}:\n  expected {expected}\n  actual   {actual}')
+    print(f'{path.name}: checked {", ".join(b.name for b in backends)}')
+  return mismatches
+
+if __name__ == '__main__':
+  fixtures = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+  failed = check_parity(fixtures)
+  print('parity OK' if not failed else f'{failed} mismatches')
+  sys.exit(1 if failed else 0)
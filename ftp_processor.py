@@ -151,9 +151,9 @@ class FTPProcessor:
       
       time.sleep(interval)
 
-def start_ftp_processor(interval=30):
-  # start the FTP file processor in a separate thread
-  ftp_processor = FTPProcessor()
+def start_ftp_processor(interval=30, **options):
+  # start the FTP file processor in a separate thread, options go to FTPProcessor
+  ftp_processor = FTPProcessor(**options)
   thread = threading.Thread(
     target=ftp_processor.run_periodic_tasks, 
     kwargs={'interval': interval}, 
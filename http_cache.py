@@ -0,0 +1,171 @@
+# http_cache.py
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+# seconds a cached page is served without asking the server again
+DEFAULT_TTLS = {
+  'listing': 5 * 60,
+  'detail': 7 * 24 * 3600,
+}
+
+def url_class(url):
+  # listing pages change all the time, an ad's detail page almost never does
+  return 'listing' if '/list/' in url else 'detail'
+
+class HTTPCache:
+  # on-disk page cache keyed by URL, stale entries are revalidated with If-None-Match / If-Modified-Since
+  def __init__(self, cache_dir='http_cache', max_bytes=256 * 1024 * 1024, ttls=None, save_every=50):
+    self.cache_dir = Path(cache_dir).resolve()
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    self.index_path = self.cache_dir / 'index.json'
+    self.max_bytes = max_bytes
+    self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+    self.save_every = save_every
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()  # url -> entry, least recently used first
+    self.total_bytes = 0
+    self.unsaved = 0
+    self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.index_path) as f:
+        entries = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      entries = []
+    for entry in entries:
+      if 'location' in entry or (self.cache_dir / entry['file']).exists():
+        self.entries[entry['url']] = entry
+        self.total_bytes += entry.get('size', 0)
+    # drop body files left behind by a run that crashed before saving the index
+    known = {entry.get('file') for entry in self.entries.values()}
+    for path in self.cache_dir.glob('*.body'):
+      if path.name not in known:
+        path.unlink(missing_ok=True)
+
+  def save(self):
+    with self.lock:
+      entries = list(self.entries.values())
+      self.unsaved = 0
+    tmp_path = self.index_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(entries, f)
+    os.replace(tmp_path, self.index_path)
+
+  def changed(self):
+    self.unsaved += 1
+    return self.unsaved >= self.save_every
+
+  def lookup(self, url):
+    with self.lock:
+      entry = self.entries.get(url)
+      if entry is not None:
+        self.entries.move_to_end(url)
+      return entry
+
+  def is_fresh(self, entry):
+    if 'location' in entry:
+      return True
+    return time.time() - entry['stored_at'] < self.ttls[url_class(entry['url'])]
+
+  def validators(self, entry):
+    headers = {}
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+  def read(self, entry):
+    with open(self.cache_dir / entry['file'], encoding='utf-8') as f:
+      return f.read()
+
+  def hit(self, entry):
+    with self.lock:
+      self.counters['hits'] += 1
+    return self.read(entry)
+
+  def miss(self):
+    with self.lock:
+      self.counters['misses'] += 1
+
+  def revalidated(self, entry, headers):
+    # 304 Not Modified, the stored body is still good for another ttl
+    with self.lock:
+      self.counters['revalidated'] += 1
+      entry['stored_at'] = time.time()
+      entry['etag'] = headers.get('etag', entry.get('etag'))
+      entry['last_modified'] = headers.get('last-modified', entry.get('last_modified'))
+      should_save = self.changed()
+    if should_save:
+      self.save()
+    return self.read(entry)
+
+  def store_redirect(self, url, location):
+    # only permanent redirects are remembered
+    with self.lock:
+      self.entries[url] = {'url': url, 'location': location, 'size': 0}
+      should_save = self.changed()
+    if should_save:
+      self.save()
+
+  def store(self, url, headers, chunks):
+    # passes the text chunks through and commits the entry once the whole body was written
+    name = hashlib.sha1(url.encode()).hexdigest() + '.body'
+    tmp_path = self.cache_dir / (name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+    os.replace(tmp_path, self.cache_dir / name)
+    size = os.path.getsize(self.cache_dir / name)
+
+    entry = {
+      'url': url,
+      'file': name,
+      'etag': headers.get('etag'),
+      'last_modified': headers.get('last-modified'),
+      'stored_at': time.time(),
+      'size': size,
+    }
+    with self.lock:
+      old = self.entries.pop(url, None)
+      if old:
+        self.total_bytes -= old.get('size', 0)
+      self.entries[url] = entry
+      self.total_bytes += size
+      self.counters['stores'] += 1
+      evicted = self.evict()
+      should_save = self.changed()
+    for path in evicted:
+      path.unlink(missing_ok=True)
+    if should_save:
+      self.save()
+
+  def evict(self):
+    # least recently used entries go first until the cache fits in max_bytes again
+    evicted = []
+    while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+      _, entry = self.entries.popitem(last=False)
+      self.total_bytes -= entry.get('size', 0)
+      self.counters['evictions'] += 1
+      if 'file' in entry:
+        evicted.append(self.cache_dir / entry['file'])
+    return evicted
+
+  def stats(self):
+    with self.lock:
+      lookups = self.counters['hits'] + self.counters['revalidated'] + self.counters['misses']
+      served = self.counters['hits'] + self.counters['revalidated']
+      return {
+        **self.counters,
+        'entries': len(self.entries),
+        'bytes': self.total_bytes,
+        'hit_ratio': served / lookups if lookups else 0.0,
+      }
@@ -0,0 +1,283 @@
+# http_client.py
+import codecs
+import socket
+import ssl
+import threading
+import zlib
+from collections import defaultdict
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+
+# bytes requested per recv_into call, the read buffer starts at this size
+RECV_SIZE = 65536
+
+class DeflateDecoder:
+  # "deflate" is sent both zlib-wrapped and raw in the wild, detect it on the first chunk
+  def __init__(self):
+    self.decoder = zlib.decompressobj()
+    self.started = False
+
+  def decompress(self, data):
+    if not self.started:
+      self.started = True
+      try:
+        return self.decoder.decompress(data)
+      except zlib.error:
+        self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self.decoder.decompress(data)
+
+  def flush(self):
+    return self.decoder.flush()
+
+def content_decoder(encoding):
+  encoding = (encoding or '').strip().lower()
+  if encoding in ('gzip', 'x-gzip'):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if encoding == 'deflate':
+    return DeflateDecoder()
+  if encoding in ('', 'identity'):
+    return None
+  raise ValueError(f'Unsupported content encoding: {encoding}')
+
+class SocketReader:
+  # buffered reader that receives into one preallocated bytearray instead of concatenating bytes
+  def __init__(self, sock, size=RECV_SIZE):
+    self.sock = sock
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.start = 0
+    self.end = 0
+
+  def fill(self):
+    if self.start == self.end:
+      self.start = self.end = 0
+    elif self.start:
+      # move the unread tail to the front to make room
+      pending = self.end - self.start
+      self.buffer[:pending] = self.view[self.start:self.end]
+      self.start, self.end = 0, pending
+    if self.end == len(self.buffer):
+      # a single line is larger than the buffer, grow it
+      self.view.release()
+      self.buffer.extend(bytes(len(self.buffer)))
+      self.view = memoryview(self.buffer)
+    received = self.sock.recv_into(self.view[self.end:])
+    self.end += received
+    return received
+
+  def readline(self, limit=65536):
+    while True:
+      newline = self.buffer.find(b'\n', self.start, self.end)
+      if newline >= 0:
+        line = bytes(self.view[self.start:newline + 1])
+        self.start = newline + 1
+        return line
+      if self.end - self.start > limit:
+        raise ConnectionError('Response line too long')
+      if not self.fill():
+        line = bytes(self.view[self.start:self.end])
+        self.start = self.end
+        return line
+
+  def iter_exact(self, size):
+    remaining = size
+    while remaining:
+      if self.start == self.end and not self.fill():
+        raise ConnectionError('Connection closed before the full body was received')
+      count = min(remaining, self.end - self.start)
+      yield bytes(self.view[self.start:self.start + count])
+      self.start += count
+      remaining -= count
+
+  def iter_until_close(self):
+    while self.start < self.end or self.fill():
+      yield bytes(self.view[self.start:self.end])
+      self.start = self.end
+
+  def iter_chunked(self):
+    while True:
+      size_line = self.readline()
+      if not size_line:
+        raise ConnectionError('Connection closed inside a chunked body')
+      # chunk size is hex, optionally followed by ;extensions
+      size = int(size_line.split(b';')[0].strip(), 16)
+      if size == 0:
+        break
+      yield from self.iter_exact(size)
+      self.readline()
+    # skip trailers up to the final empty line
+    while self.readline() not in (b'\r\n', b'\n', b''):
+      pass
+
+class HTTPResponse:
+  # the body is streamed from the socket, the connection is released once it is fully read
+  def __init__(self, status, headers, raw, on_close=None):
+    self.status = status
+    self.headers = headers  # header names are lowercased
+    self.raw = raw
+    self.on_close = on_close
+    self._body = None
+
+  def iter_content(self):
+    if self._body is not None:
+      yield self._body
+      return
+    finished = False
+    try:
+      decoder = content_decoder(self.headers.get('content-encoding'))
+      for chunk in self.raw:
+        data = decoder.decompress(chunk) if decoder else chunk
+        if data:
+          yield data
+      if decoder:
+        tail = decoder.flush()
+        if tail:
+          yield tail
+      finished = True
+    finally:
+      self.close(finished)
+
+  def iter_text(self, encoding='utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in self.iter_content():
+      text = decoder.decode(chunk)
+      if text:
+        yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+      yield tail
+
+  @property
+  def body(self):
+    if self._body is None:
+      self._body = b''.join(self.iter_content())
+    return self._body
+
+  def text(self, encoding='utf-8'):
+    return ''.join(self.iter_text(encoding))
+
+  def close(self, finished=False):
+    if self.on_close:
+      on_close, self.on_close = self.on_close, None
+      on_close(finished)
+
+class Connection:
+  # one persistent HTTP/1.1 connection over TLS
+  def __init__(self, host, port, context, session=None, timeout=30):
+    self.host = host
+    self.port = port
+    sock = socket.create_connection((host, port), timeout=timeout)
+    self.sock = context.wrap_socket(sock, server_hostname=host, session=session)
+    self.reader = SocketReader(self.sock)
+    self.reusable = True
+
+  def request(self, path, headers=None):
+    # the connection is always TLS, any other port has to be named in Host
+    host = self.host if self.port == 443 else f'{self.host}:{self.port}'
+    lines = [f'GET {path} HTTP/1.1', f'Host: {host}', f'User-Agent: {USER_AGENT}', 'Accept-Encoding: gzip, deflate', 'Connection: keep-alive']
+    lines += [f'{key}: {value}' for key, value in (headers or {}).items()]
+    self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    return self.read_response()
+
+  def read_response(self):
+    status_line = self.reader.readline()
+    if not status_line:
+      raise ConnectionError('Connection closed by server')
+    # status line looks like: HTTP/1.1 301 Moved Permanently
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+      line = self.reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      key, _, value = line.decode('latin-1').partition(':')
+      headers[key.strip().lower()] = value.strip()
+
+    if headers.get('connection', '').lower() == 'close':
+      self.reusable = False
+
+    if status in (204, 304) or 100 <= status < 200:
+      raw = iter(())
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+      raw = self.reader.iter_chunked()
+    elif 'content-length' in headers:
+      raw = self.reader.iter_exact(int(headers['content-length']))
+    else:
+      # no length given, the body ends when the server closes the connection
+      raw = self.reader.iter_until_close()
+      self.reusable = False
+    return HTTPResponse(status, headers, raw)
+
+  def close(self):
+    self.reusable = False
+    try:
+      self.sock.close()
+    except OSError:
+      pass
+
+class ConnectionPool:
+  # keeps idle keep-alive connections per host and reuses TLS sessions between handshakes
+  def __init__(self, max_idle_per_host=8, timeout=30, context=None):
+    self.context = context or ssl.create_default_context()
+    self.max_idle_per_host = max_idle_per_host
+    self.timeout = timeout
+    self.idle = defaultdict(list)
+    self.sessions = {}
+    self.lock = threading.Lock()
+
+  def acquire(self, host, port):
+    with self.lock:
+      idle = self.idle[(host, port)]
+      if idle:
+        return idle.pop(), True
+      session = self.sessions.get((host, port))
+    return Connection(host, port, self.context, session, self.timeout), False
+
+  def release(self, conn):
+    if not conn.reusable:
+      conn.close()
+      return
+    with self.lock:
+      key = (conn.host, conn.port)
+      if conn.sock.session is not None:
+        self.sessions[key] = conn.sock.session
+      if len(self.idle[key]) < self.max_idle_per_host:
+        self.idle[key].append(conn)
+        return
+    conn.close()
+
+  def request(self, host, path, port=443, headers=None):
+    # the returned response streams its body, the connection goes back to the pool once it is read
+    conn, reused = self.acquire(host, port)
+    try:
+      response = conn.request(path, headers)
+    except (ConnectionError, OSError):
+      conn.close()
+      if not reused:
+        raise
+      # the server dropped an idle connection, retry once on a fresh one
+      conn = Connection(host, port, self.context, self.sessions.get((host, port)), self.timeout)
+      try:
+        response = conn.request(path, headers)
+      except Exception:
+        conn.close()
+        raise
+    except Exception:
+      conn.close()
+      raise
+
+    def on_close(finished):
+      if finished:
+        self.release(conn)
+      else:
+        conn.close()
+    response.on_close = on_close
+    return response
+
+  def close(self):
+    with self.lock:
+      connections = [conn for idle in self.idle.values() for conn in idle]
+      self.idle.clear()
+    for conn in connections:
+      conn.close()
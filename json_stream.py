@@ -0,0 +1,101 @@
+# json_stream.py
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r'\s*')
+DELIMITERS = ' \t\r\n,:]}'
+
+class ArrayItemStream:
+  # push parser that yields the elements of one array as the JSON document arrives in chunks
+  # the array is either the whole document or the value of `key` in a top-level object,
+  # only the element being parsed is held in memory
+  def __init__(self, key, max_value_chars=1024 * 1024):
+    self.key = key
+    self.max_value_chars = max_value_chars
+    self.text = codecs.getincrementaldecoder('utf-8')()
+    self.decoder = json.JSONDecoder()
+    self.buffer = ''
+    self.state = 'document'
+    self.in_object = False
+    self.current_key = None
+    self.found = False
+
+  def decode(self, pos, final):
+    # (value, end) once the value at pos is complete, None while more input is needed
+    try:
+      value, end = self.decoder.raw_decode(self.buffer, pos)
+    except json.JSONDecodeError:
+      if final:
+        raise
+      return None
+    # a number cut by the chunk boundary ("12", "1e") still decodes, only trust values followed by a delimiter
+    if not final and (end == len(self.buffer) or self.buffer[end] not in DELIMITERS):
+      return None
+    return value, end
+
+  def feed(self, data, final=False):
+    # returns the array elements completed by this chunk, pass final=True with the last one
+    self.buffer += self.text.decode(data, final)
+    items = []
+    pos = 0
+    while True:
+      pos = WHITESPACE.match(self.buffer, pos).end()
+      if pos == len(self.buffer):
+        break
+      char = self.buffer[pos]
+
+      if self.state == 'document':
+        if char == '{':
+          self.state, self.in_object = 'key', True
+        elif char == '[':
+          self.state, self.found = 'items', True
+        else:
+          raise ValueError('expected a JSON object or array')
+        pos += 1
+      elif self.state == 'key':
+        if char in ',}':
+          self.state = 'done' if char == '}' else 'key'
+          pos += 1
+          continue
+        decoded = self.decode(pos, final)
+        if decoded is None:
+          break
+        self.current_key, pos = decoded
+        self.state = 'colon'
+      elif self.state == 'colon':
+        if char != ':':
+          raise ValueError(f'expected ":" after "{self.current_key}"')
+        self.state = 'value'
+        pos += 1
+      elif self.state == 'value':
+        if self.current_key == self.key and char == '[':
+          self.state, self.found = 'items', True
+          pos += 1
+          continue
+        # anything else at the top level is skipped
+        decoded = self.decode(pos, final)
+        if decoded is None:
+          break
+        _, pos = decoded
+        self.state = 'key'
+      elif self.state == 'items':
+        if char in ',]':
+          if char == ']':
+            self.state = 'key' if self.in_object else 'done'
+          pos += 1
+          continue
+        decoded = self.decode(pos, final)
+        if decoded is None:
+          break
+        item, pos = decoded
+        items.append(item)
+      else:
+        raise ValueError('unexpected data after the end of the document')
+
+    self.buffer = self.buffer[pos:]
+    if len(self.buffer) > self.max_value_chars:
+      raise ValueError(f'a JSON value is longer than {self.max_value_chars} characters')
+    if final and self.state != 'done':
+      raise ValueError('JSON document ends early')
+    return items
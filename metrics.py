@@ -0,0 +1,320 @@
+# metrics.py
+# per-route request metrics, per-request database query accounting and the structured request log
+import asyncio
+import atexit
+import bisect
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import event
+
+# histogram upper bounds in seconds, the last bucket takes everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# where request records are appended, empty disables the log
+REQUEST_LOG = os.getenv('REQUEST_LOG', 'logs/requests.jsonl')
+# requests slower than this are profiled and dumped to PROFILE_DIR, 0 keeps the profiler off
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'logs/profiles')
+
+# the RequestStats of the request being handled, engine events add their queries to it
+current_request = contextvars.ContextVar('current_request', default=None)
+
+class Histogram:
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.total += value
+
+  def quantile(self, q):
+    # linear inside the bucket holding the q-th observation, the open last bucket reports its lower bound
+    if not self.count:
+      return None
+    target = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      if count and seen + count >= target:
+        if i == len(self.bounds):
+          return self.bounds[-1]
+        low = self.bounds[i - 1] if i else 0.0
+        return low + (self.bounds[i] - low) * (target - seen) / count
+      seen += count
+    return self.bounds[-1]
+
+  def snapshot(self):
+    cumulative = 0
+    buckets = {}
+    for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+      cumulative += count
+      buckets[f'le_{bound}'] = cumulative
+    return {
+      'count': self.count,
+      'sum_ms': round(self.total * 1000, 3),
+      'mean_ms': round(self.total / self.count * 1000, 3) if self.count else None,
+      **{f'p{int(q * 100)}_ms': round(self.quantile(q) * 1000, 3) if self.count else None for q in (0.5, 0.9, 0.99)},
+      'buckets': buckets,
+    }
+
+class RequestStats:
+  # what one request did in the database
+  def __init__(self):
+    self.queries = 0
+    self.query_seconds = 0.0
+    self.slowest = None
+
+  def add_query(self, statement, seconds):
+    self.queries += 1
+    self.query_seconds += seconds
+    if self.slowest is None or seconds > self.slowest[0]:
+      self.slowest = (seconds, statement)
+
+class RouteMetrics:
+  def __init__(self):
+    self.latency = Histogram(LATENCY_BUCKETS)
+    self.statuses = {}
+    self.queries = 0
+    self.query_seconds = 0.0
+
+  def snapshot(self):
+    return {
+      'latency': self.latency.snapshot(),
+      'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+      'queries': self.queries,
+      'queries_per_request': round(self.queries / self.latency.count, 3) if self.latency.count else None,
+      'query_ms': round(self.query_seconds * 1000, 3),
+    }
+
+class Metrics:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.routes = {}  # 'METHOD /route/{template}' -> RouteMetrics
+    self.queries = Histogram(QUERY_BUCKETS)
+
+  def observe_request(self, method, route, status, seconds, stats):
+    with self.lock:
+      metrics = self.routes.get(f'{method} {route}')
+      if metrics is None:
+        metrics = self.routes[f'{method} {route}'] = RouteMetrics()
+      metrics.latency.observe(seconds)
+      metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+      metrics.queries += stats.queries
+      metrics.query_seconds += stats.query_seconds
+
+  def observe_query(self, seconds):
+    with self.lock:
+      self.queries.observe(seconds)
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'uptime_seconds': round(time.time() - self.started, 1),
+        'routes': {name: metrics.snapshot() for name, metrics in sorted(self.routes.items())},
+        'database': {'queries': self.queries.snapshot()},
+      }
+
+class RequestLog:
+  # appends request records as JSON lines from a background thread, the request path only enqueues
+  # when the writer falls behind records are dropped and counted instead of blocking requests
+  def __init__(self, path, max_pending=10000, batch_size=1000):
+    self.path = Path(path)
+    self.queue = queue.Queue(max_pending)
+    self.batch_size = batch_size
+    self.written = 0
+    self.dropped = 0
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='request-log', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+  def write(self, record):
+    if self.thread is None:
+      self.start()
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+  def run(self):
+    with open(self.path, 'a', encoding='utf-8') as f:
+      while True:
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not None:
+          try:
+            batch.append(self.queue.get_nowait())
+          except queue.Empty:
+            break
+        stop = batch[-1] is None
+        records = batch[:-1] if stop else batch
+        f.write(''.join(json.dumps(record, default=str) + '\n' for record in records))
+        self.written += len(records)
+        if stop or self.queue.empty():
+          f.flush()
+        if stop:
+          return
+
+  def close(self):
+    # flushes what is queued, called at exit and on app shutdown
+    thread = self.thread
+    if thread is not None and thread.is_alive():
+      self.queue.put(None)
+      thread.join(timeout=5)
+
+  def stats(self):
+    return {'path': str(self.path), 'written': self.written, 'dropped': self.dropped, 'pending': self.queue.qsize()}
+
+class SlowRequestProfiler:
+  # profiles one request at a time and keeps the profile only when the request turned out slow
+  # cProfile follows the event loop thread, so requests overlapping the profiled one can show up in it
+  # and work handed to the threadpool does not
+  def __init__(self, threshold_ms, directory):
+    self.threshold_ms = threshold_ms
+    self.directory = Path(directory)
+    self.active = False
+    self.dumped = 0
+
+  def start(self):
+    if self.active:
+      return None
+    self.active = True
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+  def finish(self, profile, record):
+    profile.disable()
+    self.active = False
+    if record['ms'] >= self.threshold_ms:
+      self.dumped += 1
+      # pstats formatting takes a while, keep it off the event loop
+      asyncio.get_running_loop().run_in_executor(None, self.dump, profile, record)
+
+  def dump(self, profile, record):
+    self.directory.mkdir(parents=True, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{record['method']}-{record['route'].strip('/').replace('/', '_') or 'root'}"
+    profile.dump_stats(self.directory / f'{name}.prof')
+    with open(self.directory / f'{name}.txt', 'w') as f:
+      f.write(json.dumps(record, default=str) + '\n\n')
+      pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(40)
+
+  def stats(self):
+    return {'threshold_ms': self.threshold_ms, 'directory': str(self.directory), 'dumped': self.dumped}
+
+class StartupReport:
+  # how long the process took to get going, counted from the first line of webserver.py
+  def __init__(self):
+    self.started = None
+    self.marks = {}
+
+  def begin(self, started):
+    self.started = started
+
+  def mark(self, name):
+    if self.started is not None and name not in self.marks:
+      self.marks[name] = time.perf_counter() - self.started
+
+  def snapshot(self):
+    return {f'{name}_ms': round(seconds * 1000, 3) for name, seconds in self.marks.items()}
+
+registry = Metrics()
+startup = StartupReport()
+request_log = RequestLog(REQUEST_LOG) if REQUEST_LOG else None
+profiler = SlowRequestProfiler(SLOW_REQUEST_MS, PROFILE_DIR) if SLOW_REQUEST_MS > 0 else None
+
+def instrument_engine(engine):
+  # counts every statement and its time, globally and for the request that ran it
+  @event.listens_for(engine, 'before_cursor_execute')
+  def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+  @event.listens_for(engine, 'after_cursor_execute')
+  def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    registry.observe_query(seconds)
+    stats = current_request.get()
+    if stats is not None:
+      stats.add_query(statement, seconds)
+
+  @event.listens_for(engine, 'handle_error')
+  def handle_error(context):
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+      started.pop()
+
+class MetricsMiddleware:
+  # plain ASGI middleware, streamed responses pass through untouched
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http':
+      await self.app(scope, receive, send)
+      return
+
+    stats = RequestStats()
+    token = current_request.set(stats)
+    status = 500
+
+    async def send_with_status(message):
+      nonlocal status
+      if message['type'] == 'http.response.start':
+        status = message['status']
+      await send(message)
+
+    profile = profiler.start() if profiler else None
+    started = time.perf_counter()
+    try:
+      await self.app(scope, receive, send_with_status)
+    finally:
+      seconds = time.perf_counter() - started
+      current_request.reset(token)
+      # the route template, not the concrete path, so /cars/1 and /cars/2 share one series
+      route = scope.get('route')
+      route = route.path if route is not None else 'unmatched'
+      registry.observe_request(scope['method'], route, status, seconds, stats)
+
+      record = {
+        'ts': datetime.now().isoformat(),
+        'method': scope['method'],
+        'path': scope['path'],
+        'route': route,
+        'status': status,
+        'ms': round(seconds * 1000, 3),
+        'queries': stats.queries,
+        'db_ms': round(stats.query_seconds * 1000, 3),
+      }
+      if SLOW_REQUEST_MS > 0 and record['ms'] >= SLOW_REQUEST_MS and stats.slowest:
+        record['slowest_query'] = {'ms': round(stats.slowest[0] * 1000, 3), 'statement': stats.slowest[1][:500]}
+      if profile is not None:
+        profiler.finish(profile, record)
+      if request_log is not None:
+        request_log.write(record)
+      startup.mark('first_request')
+
+def snapshot():
+  return {
+    **registry.snapshot(),
+    'startup': startup.snapshot(),
+    'request_log': request_log.stats() if request_log else None,
+    'slow_request_profiler': profiler.stats() if profiler else None,
+  }
@@ -1,52 +1,394 @@
 # rabbitmq_consumer.py
-import pika
-import requests
+# stores the scraped cars from the car_data queue straight in the database, batched across messages
+import os
 import json
+import time
+import signal
+import argparse
+import multiprocessing
+from queue import Empty
+import pika
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
+from database import Session, bulk_upsert_cars, car_row, init_db
+from car_schema import car_event
 
-def callback(ch, method, properties, body):
-  try:
-    message_data = json.loads(body.decode('utf-8'))
-    print(f"[x] Received message: {json.dumps(message_data)}")
-    
-    url = "http://localhost:8001/cars"
-    headers = {'Content-Type': 'application/json'}
-    cars = message_data.get('products_filtered', [])
-    
-    for car_data in cars:
-      car_payload = {
-        "name": car_data.get('name', ''),
-        "price_mdl": car_data.get('price_mdl', 0.0),
-        "link": car_data.get('link', ''),
-        "kilometrage": car_data.get('kilometrage', 0),
-        "color": car_data.get('color', '')
-      }
-      
-      response = requests.post(url, json=car_payload, headers=headers)
-      
-      if response.status_code == 200:
-        print(f"[x] Successfully posted car data: {response.json()}")
-      else:
-        print(f"[x] Failed to post car data, status code: {response.status_code}, response: {response.text}")
-  
-  except json.JSONDecodeError:
-    print(f"[x] Received invalid JSON")
-  except Exception as e:
-    print(f"[x] An error occurred: {e}")
-        
-def start_consumer():
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
+QUEUE_NAME = 'car_data'
+# a batch is written once it holds this many cars or its oldest message waited SINK_FLUSH_SECONDS
+SINK_BATCH_SIZE = int(os.getenv('SINK_BATCH_SIZE', '1000'))
+SINK_FLUSH_SECONDS = float(os.getenv('SINK_FLUSH_SECONDS', '1'))
+# unacked messages the broker hands out, a batch is also written when it holds this many
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '100'))
+# worker processes started by start_consumer, each with its own connection, channel and prefetch window
+CONSUMER_WORKERS = int(os.getenv('CONSUMER_WORKERS', '1'))
+# how often workers report their counters and the queue depth is printed
+CONSUMER_STATS_SECONDS = float(os.getenv('CONSUMER_STATS_SECONDS', '10'))
+# wait before taking messages again after a failed write
+MAX_RETRY_DELAY = 30
+# errors a row itself causes, a retry would run into them again
+# anything else, a lost connection or a missing table say, fails every message alike and is requeued
+REJECTED_ERRORS = (DataError, IntegrityError)
+# a worker that dies this soon after starting is restarted with a growing delay
+RESTART_WINDOW = 10
+
+class CarSink:
+  # buffers the cars of several messages, writes them with one bulk upsert and only then acks the messages
+  # a crash before the ack gets them redelivered, the upsert is keyed on link so replaying them is harmless
+  # with a feed, a ChangePublisher, the stored cars go out to websocket subscribers as upserted events
+  def __init__(self, channel, batch_size=SINK_BATCH_SIZE, flush_seconds=SINK_FLUSH_SECONDS, max_messages=CONSUMER_PREFETCH, feed=None):
+    self.channel = channel
+    self.batch_size = batch_size
+    self.flush_seconds = flush_seconds
+    self.max_messages = max_messages
+    self.feed = feed
+    self.messages = []  # (delivery tag, rows) in delivery order
+    self.buffered = 0
+    self.oldest = None
+    self.stats = {'messages': 0, 'cars': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'rejected': 0, 'batches': 0, 'failed': 0, 'seconds': 0.0}
+
+  def receive(self, delivery_tag, body):
+    # returns False when a write failed and the buffered messages went back to the queue
+    try:
+      message = json.loads(body)
+      items = message.get('products_filtered') if isinstance(message, dict) else None
+      if not isinstance(items, list):
+        raise ValueError('no products_filtered list')
+    except (UnicodeDecodeError, ValueError) as e:
+      # redelivering it would fail the same way
+      print(f'[x] Dropping invalid message: {e}')
+      self.channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+      self.stats['rejected'] += 1
+      return True
+
+    rows = [row for row in map(car_row, items) if row is not None]
+    self.stats['skipped'] += len(items) - len(rows)
+    if not self.messages:
+      self.oldest = time.monotonic()
+    self.messages.append((delivery_tag, rows))
+    self.buffered += len(rows)
+    if self.buffered >= self.batch_size or len(self.messages) >= self.max_messages:
+      return self.flush()
+    return True
+
+  def due(self):
+    return bool(self.messages) and time.monotonic() - self.oldest >= self.flush_seconds
+
+  def store(self, rows):
+    # one transaction, returns (inserted, updated)
+    if not rows:
+      return 0, 0
+    changes = [] if self.feed is not None else None
+    db = Session()
+    try:
+      inserted, updated = bulk_upsert_cars(db, rows, changes=changes)
+      db.commit()
+    except SQLAlchemyError:
+      db.rollback()
+      raise
+    finally:
+      db.close()
+    for car_id, car, before in changes or ():
+      self.feed.emit_threadsafe('upserted', car_event(car), before, car_id)
+    return inserted, updated
+
+  def flush(self):
+    if not self.messages:
+      return True
+    started = time.perf_counter()
+    messages, cars = self.messages, self.buffered
+    self.clear()
+    try:
+      inserted, updated = self.store([row for _, rows in messages for row in rows])
+    except REJECTED_ERRORS as e:
+      # a row the database refuses would fail every retry of the batch, its message is found and dropped
+      print(f'[x] Storing {cars} cars failed, writing their {len(messages)} messages one by one: {getattr(e, "orig", e)}')
+      return self.flush_each(messages)
+    except SQLAlchemyError as e:
+      print(f'[x] Storing {cars} cars failed, requeueing {len(messages)} messages: {e}')
+      self.channel.basic_nack(delivery_tag=messages[-1][0], multiple=True, requeue=True)
+      self.stats['failed'] += 1
+      return False
+
+    # delivery tags grow per channel and every earlier message is settled, one ack covers the whole batch
+    self.channel.basic_ack(delivery_tag=messages[-1][0], multiple=True)
+    elapsed = time.perf_counter() - started
+    self.count(len(messages), cars, inserted, updated, elapsed)
+    print(f'[x] Stored {cars} cars from {len(messages)} messages, {inserted} inserted, {updated} updated, {elapsed:.3f}s')
+    return True
+
+  def flush_each(self, messages):
+    # every message its own transaction, acked on success and rejected for good when the database refuses it
+    for i, (delivery_tag, rows) in enumerate(messages):
+      started = time.perf_counter()
+      try:
+        inserted, updated = self.store(rows)
+      except REJECTED_ERRORS as e:
+        print(f'[x] Dropping a message the database refuses: {getattr(e, "orig", e)}')
+        self.channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+        self.stats['rejected'] += 1
+        continue
+      except SQLAlchemyError as e:
+        print(f'[x] Storing a message failed, requeueing {len(messages) - i} messages: {e}')
+        self.channel.basic_nack(delivery_tag=messages[-1][0], multiple=True, requeue=True)
+        self.stats['failed'] += 1
+        return False
+      self.channel.basic_ack(delivery_tag=delivery_tag)
+      self.count(1, len(rows), inserted, updated, time.perf_counter() - started)
+    return True
+
+  def count(self, messages, cars, inserted, updated, seconds):
+    self.stats['messages'] += messages
+    self.stats['cars'] += cars
+    self.stats['inserted'] += inserted
+    self.stats['updated'] += updated
+    self.stats['batches'] += 1
+    self.stats['seconds'] += seconds
+
+  def clear(self):
+    self.messages = []
+    self.buffered = 0
+    self.oldest = None
+
+def connect(host=RABBITMQ_HOST, queue=QUEUE_NAME, prefetch=CONSUMER_PREFETCH):
   connection = pika.BlockingConnection(
     pika.ConnectionParameters(
-        host='localhost', 
+        host=host,
         port=5672,
         credentials=pika.PlainCredentials('guest', 'guest')
     )
   )
   channel = connection.channel()
-  channel.queue_declare(queue='car_data')
-  
-  channel.basic_consume(queue='car_data', on_message_callback=callback, auto_ack=True)
+  channel.queue_declare(queue=queue, durable=True)
+  # without a limit the broker pushes the whole queue into a consumer that only acks per batch
+  channel.basic_qos(prefetch_count=prefetch)
+  return connection, channel
+
+
+def queue_depth(host=RABBITMQ_HOST, queue=QUEUE_NAME):
+  # (ready messages, consumers) as the broker counts them, unacked messages in workers' windows aren't included
+  connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=5672, credentials=pika.PlainCredentials('guest', 'guest')))
+  try:
+    method = connection.channel().queue_declare(queue=queue, durable=True, passive=True).method
+    return method.message_count, method.consumer_count
+  finally:
+    connection.close()
+
+class Worker:
+  # one connection and channel consuming into a CarSink
+  # writes are synchronous, so while the database is slow no message is taken and at most prefetch wait unacked
+  # stopping writes and acks what is buffered, the broker requeues the rest of the window
+  def __init__(self, index=0, host=RABBITMQ_HOST, queue=QUEUE_NAME, prefetch=CONSUMER_PREFETCH, batch_size=SINK_BATCH_SIZE,
+               reports=None, stats_interval=CONSUMER_STATS_SECONDS):
+    self.index = index
+    self.host = host
+    self.queue = queue
+    self.prefetch = prefetch
+    self.batch_size = batch_size
+    self.reports = reports
+    self.stats_interval = stats_interval
+    self.reported_cars = 0
+    self.reported_at = time.monotonic()
+    self.stopping = False
+
+  def stop(self, *args):
+    self.stopping = True
+
+  def report(self, sink, channel=None):
+    now = time.monotonic()
+    if self.reports is not None:
+      # stamped here, CLOCK_MONOTONIC is the same for every process, so the pool can tell rates however late it reads
+      self.reports.put({'worker': self.index, 'pid': os.getpid(), 'at': now, 'buffered': sink.buffered, **sink.stats})
+    elif channel is not None:
+      # a worker on its own prints what the pool would
+      depth = channel.queue_declare(queue=self.queue, durable=True, passive=True).method.message_count
+      rate = (sink.stats['cars'] - self.reported_cars) / (now - self.reported_at)
+      self.reported_cars = sink.stats['cars']
+      print(f' [*] {self.queue}: {depth} ready, {rate:.0f} cars/s stored')
+    self.reported_at = now
+
+  def run(self):
+    init_db()
+    connection, channel = connect(self.host, self.queue, self.prefetch)
+    feed = None
+    if os.getenv('CHANGE_FEED_URL'):
+      # the same publisher the API nodes use, so subscribers see scraped cars too
+      from websocket.change_feed import ChangePublisher
+      feed = ChangePublisher(os.getenv('CHANGE_FEED_URL'))
+      feed.start_thread()
+    sink = CarSink(channel, batch_size=self.batch_size, max_messages=self.prefetch, feed=feed)
+    print(f' [*] Worker {self.index} waiting for messages, prefetch {self.prefetch}')
+    delay = 1
+    try:
+      # the timeout wakes the loop while the queue is idle, so a partial batch is written on time and a stop is noticed
+      for method, properties, body in channel.consume(self.queue, inactivity_timeout=min(SINK_FLUSH_SECONDS, 1)):
+        ok = sink.receive(method.delivery_tag, body) if method is not None else True
+        if ok and sink.due():
+          ok = sink.flush()
+        if ok:
+          delay = 1
+        else:
+          # keeps answering heartbeats while the database recovers
+          connection.sleep(delay)
+          delay = min(delay * 2, MAX_RETRY_DELAY)
+        if time.monotonic() - self.reported_at >= self.stats_interval:
+          self.report(sink, channel)
+        if self.stopping:
+          break
+      sink.flush()
+    finally:
+      if connection.is_open:
+        # requeues what the broker delivered but the loop hasn't taken yet
+        channel.cancel()
+        connection.close()
+      if feed is not None:
+        feed.stop_thread()
+      self.report(sink)
+    print(f' [*] Worker {self.index} stopped: {sink.stats}')
+
+def run_worker(index, host, queue, prefetch, batch_size, reports, stats_interval):
+  # entry point of a worker process, the pool's signals only set the stop flag
+  worker = Worker(index, host, queue, prefetch, batch_size, reports, stats_interval)
+  signal.signal(signal.SIGTERM, worker.stop)
+  signal.signal(signal.SIGINT, worker.stop)
+  worker.run()
+
+class ConsumerPool:
+  # starts the worker processes, restarts the ones that exit and prints queue depth and per-worker rates
+  def __init__(self, workers, host=RABBITMQ_HOST, queue=QUEUE_NAME, prefetch=CONSUMER_PREFETCH, batch_size=SINK_BATCH_SIZE,
+               stats_interval=CONSUMER_STATS_SECONDS):
+    self.workers = workers
+    self.host = host
+    self.queue = queue
+    self.prefetch = prefetch
+    self.batch_size = batch_size
+    self.stats_interval = stats_interval
+    # spawn, not fork, every worker opens its own broker connection and database engine
+    self.context = multiprocessing.get_context('spawn')
+    self.reports = self.context.Queue()
+    self.processes = {}
+    self.started = {}
+    self.delays = {}
+    self.latest = {}
+    self.previous = {}
+    self.stopping = False
+
+  def start_worker(self, index):
+    process = self.context.Process(
+      target=run_worker, args=(index, self.host, self.queue, self.prefetch, self.batch_size, self.reports, self.stats_interval), name=f'consumer-{index}')
+    process.start()
+    self.processes[index] = process
+    self.started[index] = time.monotonic()
+
+  def start(self):
+    for index in range(self.workers):
+      self.start_worker(index)
+    print(f' [*] Started {self.workers} consumer workers on {self.queue}, prefetch {self.prefetch} each')
+
+  def supervise(self):
+    for index, process in list(self.processes.items()):
+      if self.stopping:
+        return
+      if process is not None:
+        if process.is_alive():
+          continue
+        if time.monotonic() - self.started[index] < RESTART_WINDOW:
+          self.delays[index] = min(self.delays.get(index, 0.5) * 2, MAX_RETRY_DELAY)
+        else:
+          self.delays[index] = 1
+        print(f' [*] Worker {index} exited with {process.exitcode}, restarting in {self.delays[index]}s')
+        # parked until the delay runs out
+        self.started[index] = time.monotonic() + self.delays[index]
+        self.processes[index] = None
+      elif time.monotonic() >= self.started[index]:
+        self.start_worker(index)
+
+  def collect(self):
+    while True:
+      try:
+        report = self.reports.get_nowait()
+      except Empty:
+        return
+      self.previous[report['worker']] = self.latest.get(report['worker'])
+      self.latest[report['worker']] = report
+
+  def rates(self):
+    # cars per second of every worker between its last two reports
+    rates = {}
+    for index, report in sorted(self.latest.items()):
+      previous = self.previous.get(index)
+      if previous is None or previous['pid'] != report['pid'] or report['at'] <= previous['at']:
+        rates[index] = None
+      else:
+        rates[index] = (report['cars'] - previous['cars']) / (report['at'] - previous['at'])
+    return rates
+
+  def print_stats(self):
+    self.collect()
+    try:
+      depth, consumers = queue_depth(self.host, self.queue)
+      queue = f'{depth} ready, {consumers} consumers'
+    except pika.exceptions.AMQPError as e:
+      queue = f'unknown ({e!r})'
+    rates = self.rates()
+    workers = ', '.join(f"{index}: {'-' if rate is None else f'{rate:.0f}'} cars/s" for index, rate in rates.items())
+    total = sum(rate for rate in rates.values() if rate is not None)
+    print(f' [*] {self.queue}: {queue}, {total:.0f} cars/s stored ({workers or "no reports yet"})')
+
+  def stop(self, timeout=30):
+    # every worker writes its buffered batch before it exits
+    self.stopping = True
+    running = [process for process in self.processes.values() if process is not None]
+    for process in running:
+      process.terminate()
+    deadline = time.monotonic() + timeout
+    # reading the reports while waiting, a worker can't exit while its last one is stuck in the pipe
+    while any(process.is_alive() for process in running) and time.monotonic() < deadline:
+      self.collect()
+      time.sleep(0.1)
+    for process in running:
+      if process.is_alive():
+        process.kill()
+      process.join()
+    self.collect()
+    totals = {}
+    for report in self.latest.values():
+      for key in ('messages', 'cars', 'inserted', 'updated', 'failed'):
+        totals[key] = totals.get(key, 0) + report[key]
+    print(f' [*] Consumer workers stopped: {totals}')
+
+def start_consumer(workers=CONSUMER_WORKERS, host=RABBITMQ_HOST, queue=QUEUE_NAME, prefetch=CONSUMER_PREFETCH,
+                   batch_size=SINK_BATCH_SIZE, stats_interval=CONSUMER_STATS_SECONDS):
+  if workers <= 1:
+    worker = Worker(0, host, queue, prefetch, batch_size, stats_interval=stats_interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    print(' [*] Waiting for messages. To exit press CTRL+C')
+    worker.run()
+    return
+
+  pool = ConsumerPool(workers, host, queue, prefetch, batch_size, stats_interval)
+  signal.signal(signal.SIGTERM, lambda *args: setattr(pool, 'stopping', True))
+  signal.signal(signal.SIGINT, lambda *args: setattr(pool, 'stopping', True))
+  pool.start()
   print(' [*] Waiting for messages. To exit press CTRL+C')
-  channel.start_consuming()
+  printed = time.monotonic()
+  while not pool.stopping:
+    time.sleep(0.5)
+    pool.supervise()
+    if time.monotonic() - printed >= stats_interval:
+      pool.print_stats()
+      printed = time.monotonic()
+  pool.stop()
+
+def main():
+  parser = argparse.ArgumentParser(description='Store the cars from the car_data queue in the database')
+  parser.add_argument('--workers', type=int, default=CONSUMER_WORKERS, help='consumer processes, also CONSUMER_WORKERS')
+  parser.add_argument('--prefetch', type=int, default=CONSUMER_PREFETCH, help='unacked messages per worker, also CONSUMER_PREFETCH')
+  parser.add_argument('--batch-size', type=int, default=SINK_BATCH_SIZE, help='cars per bulk upsert, also SINK_BATCH_SIZE')
+  parser.add_argument('--stats-interval', type=float, default=CONSUMER_STATS_SECONDS,
+                      help='seconds between queue depth and rate lines, also CONSUMER_STATS_SECONDS')
+  args = parser.parse_args()
+  start_consumer(args.workers, prefetch=args.prefetch, batch_size=args.batch_size, stats_interval=args.stats_interval)
 
 if __name__ == "__main__":
-  start_consumer()
\ No newline at end of file
+  main()
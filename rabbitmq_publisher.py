@@ -0,0 +1,110 @@
+# rabbitmq_publisher.py
+import os
+import json
+import time
+import pika
+
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
+QUEUE_NAME = 'car_data'
+
+class CarPublisher:
+  # one long-lived connection and channel, every message is persistent and confirmed by the broker
+  def __init__(self, host=RABBITMQ_HOST, queue=QUEUE_NAME):
+    self.host = host
+    self.queue = queue
+    self.connection = None
+    self.channel = None
+
+  def connect(self):
+    self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host, port=5672))
+    self.channel = self.connection.channel()
+    self.channel.queue_declare(queue=self.queue, durable=True)
+    self.channel.confirm_delivery()
+
+  def publish(self, data):
+    body = json.dumps(data, default=str)
+    for attempt in range(2):
+      try:
+        if self.channel is None or self.channel.is_closed:
+          self.connect()
+        # with confirms on, basic_publish blocks until the broker acks and raises on a nack
+        self.channel.basic_publish(
+          exchange='',
+          routing_key=self.queue,
+          body=body,
+          properties=pika.BasicProperties(delivery_mode=2, content_type='application/json'),
+          mandatory=True)
+        return len(body)
+      except (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosed, pika.exceptions.StreamLostError):
+        # the connection dropped, reconnect once and publish again
+        self.close()
+        if attempt:
+          raise
+
+  def keep_alive(self):
+    # lets pika answer heartbeats while the scraper is busy fetching pages
+    if self.connection is not None and self.connection.is_open:
+      self.connection.process_data_events(time_limit=0)
+
+  def close(self):
+    try:
+      if self.connection is not None and self.connection.is_open:
+        self.connection.close()
+    except Exception:
+      pass
+    self.connection = None
+    self.channel = None
+
+class StreamingPublisher:
+  # buffers products as they are scraped and publishes them in micro-batches
+  def __init__(self, process, batch_size=50, publisher=None):
+    self.process = process
+    self.batch_size = batch_size
+    self.publisher = publisher or CarPublisher()
+    self.batch = []
+    self.messages = 0
+    self.published = 0
+    self.failed = 0
+    self.last_tick = time.monotonic()
+
+  def add(self, product):
+    self.batch.append(product)
+    if len(self.batch) >= self.batch_size:
+      self.flush()
+    elif time.monotonic() - self.last_tick > 5:
+      self.last_tick = time.monotonic()
+      self.publisher.keep_alive()
+
+  def flush(self):
+    # returns False when the batch couldn't be published, its cars are counted in failed
+    batch, self.batch = self.batch, []
+    if not batch:
+      return True
+    data = self.process(batch)
+    if not data['products_filtered']:
+      return True
+    try:
+      size = self.publisher.publish(data)
+      self.messages += 1
+      self.published += len(data['products_filtered'])
+      print(f"[x] Published {len(data['products_filtered'])} cars to RabbitMQ ({size} bytes)")
+      return True
+    except Exception as e:
+      self.failed += len(data['products_filtered'])
+      print(f"[x] Error publishing to RabbitMQ: {e}")
+      return False
+    finally:
+      self.last_tick = time.monotonic()
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      self.publisher.close()
+    print(f"[x] Published {self.published} cars in {self.messages} messages, {self.failed} failed")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
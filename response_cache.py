@@ -0,0 +1,146 @@
+# response_cache.py
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# rough per-entry cost on top of the body, keeps thousands of tiny entries from escaping the bound
+ENTRY_OVERHEAD = 512
+
+def make_etag(body):
+  return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+def etag_matches(if_none_match, etag):
+  if not if_none_match:
+    return False
+  tags = [tag.strip() for tag in if_none_match.split(',')]
+  # weak comparison, W/"x" and "x" name the same representation
+  return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+def car_image(car):
+  # the columns list filters look at, taken before and after a write
+  return {key: getattr(car, key) for key in ('id', 'link', 'price_mdl', 'kilometrage', 'color', 'created_at')}
+
+def list_matches(filters, image):
+  # would the row appear in a GET /cars listing with these filters, on any page
+  def within(value, low=None, high=None, high_inclusive=True):
+    if value is None:
+      return False
+    if low is not None and value < low:
+      return False
+    if high is not None and (value > high if high_inclusive else value >= high):
+      return False
+    return True
+
+  if (filters['price_min'] is not None or filters['price_max'] is not None) and not within(image['price_mdl'], filters['price_min'], filters['price_max']):
+    return False
+  if filters['colors'] and image['color'] not in filters['colors']:
+    return False
+  if filters['kilometrage_max'] is not None and not within(image['kilometrage'], high=filters['kilometrage_max']):
+    return False
+  if (filters['created_after'] is not None or filters['created_before'] is not None) and not within(image['created_at'], filters['created_after'], filters['created_before'], high_inclusive=False):
+    return False
+  return True
+
+class CachedResponse:
+  def __init__(self, body, headers=None, filters=None, link=None):
+    self.body = body
+    self.etag = make_etag(body)
+    self.headers = headers or {}
+    self.filters = filters  # set on listings, used to decide which writes touch them
+    self.link = link  # set on single cars, bulk writes only know links
+    self.size = len(body) + ENTRY_OVERHEAD
+    self.expires = 0.0
+
+class ResponseCache:
+  # in-process LRU of serialized GET responses with a TTL and a byte bound
+  def __init__(self, max_bytes=32 * 1024 * 1024, ttl=30):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()  # key -> CachedResponse, least recently used first
+    self.total_bytes = 0
+    # bumped by every invalidation, a response built across a write is not stored
+    self.generation = 0
+    self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+  @property
+  def enabled(self):
+    return self.ttl > 0 and self.max_bytes > 0
+
+  def get(self, key):
+    if not self.enabled:
+      return None
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry.expires <= time.monotonic():
+        self.drop(key)
+        self.counters['expirations'] += 1
+        entry = None
+      if entry is None:
+        self.counters['misses'] += 1
+        return None
+      self.entries.move_to_end(key)
+      self.counters['hits'] += 1
+      return entry
+
+  def put(self, key, entry, generation):
+    if not self.enabled or entry.size > self.max_bytes:
+      return entry
+    with self.lock:
+      if generation != self.generation:
+        return entry
+      self.drop(key)
+      entry.expires = time.monotonic() + self.ttl
+      self.entries[key] = entry
+      self.total_bytes += entry.size
+      self.counters['stores'] += 1
+      while self.total_bytes > self.max_bytes:
+        self.drop(next(iter(self.entries)))
+        self.counters['evictions'] += 1
+    return entry
+
+  def drop(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.total_bytes -= entry.size
+    return entry
+
+  def invalidate_car(self, car_id, *images):
+    # drops the car itself and the listings the row was or now is part of, other listings stay cached
+    with self.lock:
+      self.generation += 1
+      stale = [key for key, entry in self.entries.items()
+               if key == ('car', car_id) or (entry.filters is not None and any(list_matches(entry.filters, image) for image in images))]
+      for key in stale:
+        self.drop(key)
+      self.counters['invalidations'] += len(stale)
+
+  def invalidate_links(self, links):
+    # bulk writes don't know the old rows, so every listing goes along with the cars behind these links
+    links = set(links)
+    with self.lock:
+      self.generation += 1
+      stale = [key for key, entry in self.entries.items() if entry.filters is not None or entry.link in links]
+      for key in stale:
+        self.drop(key)
+      self.counters['invalidations'] += len(stale)
+
+  def stats(self):
+    with self.lock:
+      lookups = self.counters['hits'] + self.counters['misses']
+      return {
+        **self.counters,
+        'entries': len(self.entries),
+        'bytes': self.total_bytes,
+        'max_bytes': self.max_bytes,
+        'ttl': self.ttl,
+        'hit_ratio': self.counters['hits'] / lookups if lookups else 0.0,
+      }
+
+def from_env():
+  return ResponseCache(
+    max_bytes=int(float(os.getenv('RESPONSE_CACHE_MAX_MB', '32')) * 1024 * 1024),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', '30')),
+  )
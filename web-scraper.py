@@ -1,19 +1,79 @@
 # web-scraper.py
-import socket
-import ssl
-from bs4 import BeautifulSoup
 import re
+import math
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit, urljoin, parse_qs, urlencode
+from array import array
 from datetime import datetime
-from functools import reduce
-import pika 
 import json
 import os
 from ftp_processor import FTPProcessor
+from http_client import ConnectionPool
+from http_cache import HTTPCache
+from extractors import get_extractor
+from rabbitmq_publisher import StreamingPublisher
 
-url = 'https://999.md/ro/list/transport/cars'
-eur_to_mdl = 19.286
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
-def fetch_page_socket(url, max_redirects=5):
+# SCRAPER_SITE points the scraper at another host, e.g. the local stand-in used by the benchmarks
+site = os.getenv('SCRAPER_SITE', 'https://999.md')
+url = f'{site}/ro/list/transport/cars'
+eur_to_mdl = float(os.getenv('EUR_TO_MDL', 19.286))
+# only ads priced inside this window (EUR) are kept
+price_min = float(os.getenv('SCRAPER_PRICE_MIN', 5000))
+price_max = float(os.getenv('SCRAPER_PRICE_MAX', 10000))
+# products per RabbitMQ message, published while the scrape is still running
+publish_batch_size = int(os.getenv('SCRAPER_PUBLISH_BATCH', 50))
+# detail pages fetched in parallel and max requests per second sent to one host
+detail_concurrency = int(os.getenv('SCRAPER_CONCURRENCY', 8))
+detail_rate_limit = float(os.getenv('SCRAPER_RATE_LIMIT', 5))
+# only fetch detail pages of ads that are new or changed since they were stored in the cars table
+incremental = os.getenv('SCRAPER_INCREMENTAL', '') == '1'
+# html extraction backend, the fastest installed one unless SCRAPER_EXTRACTOR names one
+extractor = get_extractor(os.getenv('SCRAPER_EXTRACTOR'))
+# overall requests per second for the whole scraper, 0 means no global limit
+global_rate_limit = float(os.getenv('SCRAPER_GLOBAL_RATE', 0))
+# keep-alive connections shared by every fetch, including redirect hops
+pool = ConnectionPool(max_idle_per_host=detail_concurrency)
+# conditional-request page cache, an empty SCRAPER_CACHE_DIR turns it off
+cache_dir = os.getenv('SCRAPER_CACHE_DIR', 'http_cache')
+cache_ttls = {
+  'listing': int(os.getenv('SCRAPER_CACHE_LISTING_TTL', 5 * 60)),
+  'detail': int(os.getenv('SCRAPER_CACHE_DETAIL_TTL', 7 * 24 * 3600)),
+}
+cache = HTTPCache(cache_dir, max_bytes=int(os.getenv('SCRAPER_CACHE_MAX_MB', 256)) * 1024 * 1024, ttls=cache_ttls) if cache_dir else None
+
+class HostRateLimiter:
+  # hands out evenly spaced request slots per host, shared by all worker threads
+  def __init__(self, rate):
+    self.interval = 1 / rate if rate > 0 else 0
+    self.lock = threading.Lock()
+    self.next_slot = {}
+
+  def wait(self, host):
+    if not self.interval:
+      return
+    with self.lock:
+      now = time.monotonic()
+      slot = max(now, self.next_slot.get(host, now))
+      self.next_slot[host] = slot + self.interval
+    delay = slot - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+
+# politeness budget shared by every request that actually goes to the network
+request_budget = HostRateLimiter(global_rate_limit)
+
+def fetch_page_stream(url, max_redirects=5):
+  # follows redirects, then yields the decoded body in pieces as they arrive
   for _ in range(max_redirects):
     try:
       parts = url.split('/')
@@ -22,30 +82,38 @@ def fetch_page_socket(url, max_redirects=5):
         path = '/' + '/'.join(parts[3:])
       else:
         raise ValueError('Invalid URL format')
-      
-      context = ssl.create_default_context()
-      with socket.create_connection((host, 443)) as sock:
-        with context.wrap_socket(sock, server_hostname=host) as secure_sock:
-          secure_sock.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36\r\nConnection: close\r\n\r\n".encode())
-          response = b""
-          while True:
-            data = secure_sock.recv(4096)
-            if not data:
-              break
-            response += data
-
-      headers, _, body = response.partition(b'\r\n\r\n')
-      headers = headers.decode('utf-8')
-
-      if 'HTTP/1.1 301' in headers or 'HTTP/1.1 302' in headers:
-        location = re.search(r'Location: (.*)\r\n', headers)
+
+      cached = cache.lookup(url) if cache else None
+      if cached and cache.is_fresh(cached):
+        if 'location' in cached:
+          url = cached['location']
+          continue
+        return iter((cache.hit(cached),))
+
+      hostname, _, port = host.partition(':')
+      headers = cache.validators(cached) if cached else None
+      request_budget.wait('*')
+      response = pool.request(hostname, path, port=int(port or 443), headers=headers)
+
+      if response.status == 304 and cached:
+        response.body
+        return iter((cache.revalidated(cached, response.headers),))
+
+      if response.status in (301, 302):
+        location = response.headers.get('location')
         if location:
-          url = location.group(1)
-          if not url.startswith('http'):
-            url = f'{protocol}//{host}{url}'
+          # drain the redirect body so the connection can be reused
+          response.body
+          location = location if location.startswith('http') else f'{protocol}//{host}{location}'
+          if cache and response.status == 301:
+            cache.store_redirect(url, location)
+          url = location
           continue
       
-      return body.decode('utf-8')
+      if cache and response.status == 200:
+        cache.miss()
+        return cache.store(url, response.headers, response.iter_text())
+      return response.iter_text()
 
     except Exception as e:
       print(f'Request failed: {e}')
@@ -54,15 +122,46 @@ def fetch_page_socket(url, max_redirects=5):
   print("Max redirects reached")
   return None
 
+def fetch_page_socket(url, max_redirects=5):
+  chunks = fetch_page_stream(url, max_redirects)
+  if chunks is None:
+    return None
+  try:
+    return ''.join(chunks)
+  except Exception as e:
+    print(f'Request failed: {e}')
+    return None
+
 def extract_additional_info(product_url):
-  html_content = fetch_page_socket(product_url)
-  if html_content:
-    soup = BeautifulSoup(html_content, 'html.parser')
-    color_element = soup.select_one('li.m-value[itemprop="additionalProperty"] span.adPage__content__features__key:-soup-contains("Culoarea") + span.adPage__content__features__value')
-    color = color_element.text.strip() if color_element else None
-    return color
+  chunks = fetch_page_stream(product_url)
+  if chunks is not None:
+    try:
+      return extractor.parse_color(chunks)
+    except Exception as e:
+      print(f'Request failed: {e}')
   return None
 
+def iter_colors(links, concurrency=None, rate_limit=None):
+  # fetch the detail pages concurrently, colors are yielded in the same order as links as soon as they are ready
+  concurrency = concurrency or detail_concurrency
+  limiter = HostRateLimiter(detail_rate_limit if rate_limit is None else rate_limit)
+
+  def fetch(link):
+    if not link:
+      return None
+    limiter.wait(urlsplit(link).netloc)
+    try:
+      return extract_additional_info(link)
+    except Exception as e:
+      print(f'Failed to fetch details for {link}: {e}')
+      return None
+
+  with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+    yield from executor.map(fetch, links)
+
+def fetch_colors(links, concurrency=None, rate_limit=None):
+  return list(iter_colors(links, concurrency, rate_limit))
+
 def validate_data(product):
   product['name'] = product['name'].strip() if product['name'] else None
   product['color'] = product['color'].strip() if product['color'] else None
@@ -86,48 +185,117 @@ def validate_data(product):
     
   return product
 
-def extract_product_info(soup):
-  products = []
-  product_elements = soup.select('li.ads-list-photo-item')
+def lookup_known_ads(links):
+  # imported here so the scraper only needs the database when running incrementally
+  try:
+    from database import find_cars_by_links
+    return find_cars_by_links(links)
+  except Exception as e:
+    print(f'Incremental lookup failed, fetching every detail page: {e}')
+    return {}
 
-  for element in product_elements:
-    name_element = element.select_one('div.ads-list-photo-item-title a')
-    name = name_element.text if name_element else None
-    
-    price_element = element.select_one('span.ads-list-photo-item-price-wrapper')
-    price = price_element.text if price_element else None
+def ad_changed(product, stored):
+  price_mdl = product['price'] * eur_to_mdl if product['price'] else None
+  if price_mdl is None or stored.price_mdl is None or abs(price_mdl - stored.price_mdl) > 0.01:
+    return True
+  return product['name'] != stored.name or product['kilometrage'] != stored.kilometrage
 
-    link_element = element.select_one('div.ads-list-photo-item-title a')
-    link = 'https://999.md' + link_element['href'] if link_element else None
+def in_price_window(product, low=None, high=None):
+  # the test filter_prices applies, an ad without a price is never kept
+  low = price_min if low is None else low
+  high = price_max if high is None else high
+  return low <= (product['price'] or math.nan) <= high
 
-    kilometrage_element = element.select_one('div.is-offer-type span')
-    kilometrage = kilometrage_element.text if kilometrage_element else None
+def iter_products(items, concurrency=None, rate_limit=None, seen=None, skip_known=None):
+  # turns parsed listing items into products, in listing order and as soon as each one is complete
+  # ads whose link is in seen are dropped before their detail page is fetched
+  # so is an ad listed a second time on the same page
+  # ads outside the price window are yielded without a color, process_products drops them before publishing
+  products = []
+  page_links = set()
 
-    color = extract_additional_info(link) if link else None
+  for item in items:
+    link = site + item['href'] if item['href'] else None
 
     product = {
-      'name': name,
-      'price': price,
+      'name': item['name'],
+      'price': item['price'],
       'link': link,
-      'kilometrage': kilometrage,
-      'color': color
+      'kilometrage': item['kilometrage'],
+      'color': None
     }
-  
-    validated_product = validate_data(product)
-    products.append(validated_product)
+    if seen is not None and link in seen or link in page_links:
+      continue
+    if link:
+      page_links.add(link)
+    products.append(validate_data(product))
 
-  return products
+  if skip_known is None:
+    skip_known = incremental
+  to_fetch = [p for p in products if p['link'] and in_price_window(p)]
+  if skip_known:
+    # known and unchanged ads carry their stored color forward instead of refetching it
+    known = lookup_known_ads([p['link'] for p in to_fetch])
+    wanted = to_fetch
+    to_fetch = []
+    skipped = 0
+    for product in wanted:
+      stored = known.get(product['link'])
+      if stored is not None and not ad_changed(product, stored):
+        product['color'] = stored.color
+        skipped += 1
+      else:
+        to_fetch.append(product)
+    print(f'Incremental scrape: {skipped} known ads, {len(products) - len(wanted)} outside the price window, {len(to_fetch)} detail pages to fetch')
+
+  colors = iter_colors([p['link'] for p in to_fetch], concurrency, rate_limit)
+  pending = {id(p) for p in to_fetch}
+  for product in products:
+    if id(product) in pending:
+      product['color'] = next(colors)
+    yield product
+
+def build_products(items, concurrency=None, rate_limit=None, seen=None, skip_known=None):
+  return list(iter_products(items, concurrency, rate_limit, seen, skip_known))
+
+def extract_product_info(html_content, concurrency=None, rate_limit=None, seen=None):
+  items, _ = extractor.parse_listing(html_content)
+  return build_products(items, concurrency, rate_limit, seen)
 
-def process_products(products):
-  products_mdl = list(map(lambda p: {**p, 'price_mdl': p['price'] * eur_to_mdl if p['price'] else None}, products))
-  products_filtered = list(filter(lambda p: p['price'] and 5000<= p['price'] <= 10000, products_mdl))
-  for product in products_filtered:
+def filter_prices(products, low, high, rate):
+  # columnar pass over the EUR prices: returns the kept row indexes, their MDL prices and the running total
+  if np is not None:
+    prices = np.fromiter((p['price'] or np.nan for p in products), dtype=float, count=len(products))
+    kept = np.flatnonzero((prices >= low) & (prices <= high))
+    prices_mdl = prices[kept] * rate
+    # cumsum adds left to right, so the total is bit-for-bit the same as a plain loop
+    total = float(np.cumsum(prices_mdl)[-1]) if len(kept) else 0
+    return kept.tolist(), prices_mdl.tolist(), total
+
+  prices = array('d', (p['price'] or math.nan for p in products))
+  kept = [i for i, price in enumerate(prices) if low <= price <= high]
+  prices_mdl = array('d', (prices[i] * rate for i in kept))
+  total = 0
+  for price_mdl in prices_mdl:
+    total += price_mdl
+  return kept, prices_mdl.tolist(), total
+
+def process_products(products, low=None, high=None, rate=None):
+  # only the ads that pass the price window are copied into output rows
+  low = price_min if low is None else low
+  high = price_max if high is None else high
+  rate = eur_to_mdl if rate is None else rate
+
+  kept, prices_mdl, total_price = filter_prices(products, low, high, rate)
+  products_filtered = []
+  for i, price_mdl in zip(kept, prices_mdl):
+    product = {**products[i], 'price_mdl': price_mdl}
     product['name'] = product.get('name', '').strip()
-    product['price_mdl'] = product.get('price_mdl', 0)
     product['link'] = product.get('link', '')
     product['kilometrage'] = product.get('kilometrage', 0)
     product['color'] = (product.get('color') or '').strip()
-  total_price = reduce(lambda acc, p: acc + (p['price_mdl'] or 0), products_filtered, 0)
+    products_filtered.append(product)
+
   result = {
     'products_filtered': products_filtered,
     'total_price_mdl': total_price,
@@ -135,34 +303,155 @@ def process_products(products):
   }
   return result
 
-def publish_to_rabbitmq(data):
-  try:
-    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-    channel = connection.channel()
-    channel.queue_declare(queue='car_data')
-    message = json.dumps(data, default=str)
-    channel.basic_publish(
-      exchange='', 
-      routing_key='car_data', 
-      body=message)
-    
-    print(f"[x] Published message to RabbitMQ: {message}")
-    connection.close()
-  except Exception as e:
-    print(f"[x] Error publishing to RabbitMQ: {e}")
-
-html_content = fetch_page_socket(url)
-
-if html_content:
-  print(f'Successfully fetched page: {url}')
-  soup = BeautifulSoup(html_content, 'html.parser')
-  products = extract_product_info(soup)
-  processed_data = process_products(products)
-  ftp_processor = FTPProcessor()
-  publish_to_rabbitmq(processed_data) 
-  print(f"Published data to RabbitMQ")
-  saved_file = ftp_processor.save_processed_data(processed_data)
-  if saved_file:
-    ftp_processor.upload_file_to_ftp(saved_file)
-else:
-  print(f'Failed to fetch page: {url}')
\ No newline at end of file
+def absolute_page_links(hrefs, page_url):
+  # pagination links of a listing page, as absolute urls
+  return [urljoin(page_url, href) for href in hrefs if 'page=' in href]
+
+def next_page_url(page_url):
+  parts = urlsplit(page_url)
+  query = parse_qs(parts.query)
+  page = int(query.get('page', ['1'])[0])
+  query['page'] = [str(page + 1)]
+  return parts._replace(query=urlencode(query, doseq=True)).geturl()
+
+class CrawlState:
+  # url frontier and dedupe sets of a crawl, saved after every page so a crashed crawl can resume
+  def __init__(self, path, start_url):
+    self.path = Path(path)
+    self.frontier = deque([start_url])
+    self.queued = {start_url}
+    self.seen_links = set()
+    self.failed = []
+    self.pages = 0
+    self.ads = 0
+
+  @classmethod
+  def load(cls, path, start_url):
+    state = cls(path, start_url)
+    try:
+      with open(state.path) as f:
+        data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return state
+    state.frontier = deque(data['frontier'])
+    state.queued = set(data['queued'])
+    state.seen_links = set(data['seen_links'])
+    state.failed = data.get('failed', [])
+    state.pages = data.get('pages', 0)
+    state.ads = data.get('ads', 0)
+    print(f'Resuming crawl from {state.path}: {state.pages} pages done, {len(state.frontier)} queued')
+    return state
+
+  def enqueue(self, page_url):
+    if page_url not in self.queued:
+      self.queued.add(page_url)
+      self.frontier.append(page_url)
+
+  def save(self):
+    tmp_path = self.path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump({
+        'frontier': list(self.frontier),
+        'queued': list(self.queued),
+        'seen_links': list(self.seen_links),
+        'failed': self.failed,
+        'pages': self.pages,
+        'ads': self.ads,
+      }, f)
+    os.replace(tmp_path, self.path)
+
+def crawl(start_url, max_pages=None, checkpoint='crawl_checkpoint.json'):
+  # walks every listing page through the frontier, publishing new ads in micro-batches as they are scraped
+  with StreamingPublisher(process_products, publish_batch_size) as publisher:
+    return crawl_pages(start_url, publisher, max_pages, checkpoint)
+
+def crawl_pages(start_url, publisher, max_pages, checkpoint):
+  state = CrawlState.load(checkpoint, start_url)
+  started = time.monotonic()
+  pages = ads = 0
+
+  while state.frontier and (max_pages is None or pages < max_pages):
+    page_url = state.frontier.popleft()
+    html_content = fetch_page_socket(page_url)
+    if html_content is None:
+      print(f'Failed to fetch page: {page_url}')
+      state.failed.append(page_url)
+      state.save()
+      continue
+
+    items, hrefs = extractor.parse_listing(html_content)
+    products = []
+    failed = publisher.failed
+    for product in iter_products(items, seen=state.seen_links):
+      products.append(product)
+      publisher.add(product)
+    # the checkpoint below marks this page done, so its ads must be published first
+    # add() flushes full batches on its own, a failure there shows in the failed count
+    if not publisher.flush() or publisher.failed > failed:
+      # the broker is gone even after a reconnect, the page stays first in the frontier for a resumed crawl
+      print(f'Failed to publish the ads of page {page_url}, stopping the crawl')
+      state.frontier.appendleft(page_url)
+      state.save()
+      break
+    page_links = absolute_page_links(hrefs, page_url)
+    for page_link in page_links:
+      state.enqueue(page_link)
+    if not page_links and items:
+      state.enqueue(next_page_url(page_url))
+
+    state.seen_links.update(p['link'] for p in products if p['link'])
+    state.pages += 1
+    state.ads += len(products)
+    state.save()
+
+    pages += 1
+    ads += len(products)
+    elapsed = time.monotonic() - started
+    print(f'[crawl] {page_url}: {len(products)} new ads, {pages / elapsed:.2f} pages/sec, {ads / elapsed:.2f} ads/sec, {len(state.frontier)} pages queued')
+
+  if not state.frontier:
+    print(f'Crawl finished: {state.pages} pages, {state.ads} ads, {len(state.failed)} failed pages')
+    state.path.unlink(missing_ok=True)
+  return state
+
+def scrape_page(page_url):
+  html_content = fetch_page_socket(page_url)
+
+  if html_content:
+    print(f'Successfully fetched page: {page_url}')
+    items, _ = extractor.parse_listing(html_content)
+    products = []
+    with StreamingPublisher(process_products, publish_batch_size) as publisher:
+      for product in iter_products(items):
+        products.append(product)
+        publisher.add(product)
+    processed_data = process_products(products)
+    ftp_processor = FTPProcessor()
+    saved_file = ftp_processor.save_processed_data(processed_data)
+    if saved_file:
+      ftp_processor.upload_file_to_ftp(saved_file)
+  else:
+    print(f'Failed to fetch page: {page_url}')
+
+def main():
+  parser = argparse.ArgumentParser(description='Scrape car ads from 999.md')
+  parser.add_argument('--crawl', action='store_true', help='follow pagination through the whole category')
+  parser.add_argument('--max-pages', type=int, default=None, help='stop the crawl after this many pages')
+  parser.add_argument('--checkpoint', default='crawl_checkpoint.json', help='file the crawl progress is saved to')
+  parser.add_argument('--incremental', action='store_true', help='skip detail pages of ads already stored and unchanged')
+  args = parser.parse_args()
+
+  global incremental
+  incremental = incremental or args.incremental
+
+  if args.crawl:
+    crawl(url, args.max_pages, args.checkpoint)
+  else:
+    scrape_page(url)
+
+  if cache:
+    cache.save()
+    print(f"HTTP cache: {cache.stats()}")
+
+if __name__ == '__main__':
+  main()
@@ -1,18 +1,37 @@
 # webserver.py
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Query
-from sqlalchemy.orm import Session
+import time
+# the startup report in /metrics counts from here
+IMPORT_STARTED = time.perf_counter()
+from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Double, case, func, select, true, tuple_
+from sqlalchemy.orm import aliased
 from typing import List, Optional
 import json
-from database import get_db, Car
-from datetime import datetime
-from pydantic import BaseModel
+import base64
+from sqlalchemy.engine import Engine
+from database import get_async_db, get_engine, init_db, Car, bulk_upsert_cars, car_row
+from datetime import datetime, timezone
+from pydantic import BaseModel, TypeAdapter
+import response_cache
+from response_cache import CachedResponse, car_image, etag_matches
+from json_stream import ArrayItemStream
+from car_export import EXPORT_FORMATS, export_cars
+from car_stats import read_stats
+from car_search import NameIndex, search_names, search_words
+from car_schema import CarResponse, car_event
+from anyio import to_thread
+import metrics
 import asyncio
 import threading
 import os
-from websocket.websocket_server import start_server
-from ftp_processor import start_ftp_processor
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.startup.begin(IMPORT_STARTED)
+# every engine, including the ones database.py creates on first use
+metrics.instrument_engine(Engine)
 
 class CarCreate(BaseModel):
   name: str
@@ -21,90 +40,403 @@ class CarCreate(BaseModel):
   kilometrage: Optional[int]
   color: Optional[str]
 
-class CarResponse(BaseModel):
-  id: int
-  name: str
-  price_mdl: float
-  link: str
-  kilometrage: Optional[int]
-  color: Optional[str]
-  created_at: datetime
-  updated_at: datetime
+class BulkResponse(BaseModel):
+  received: int
+  inserted: int
+  updated: int
+
+cars_adapter = TypeAdapter(List[CarResponse])
+
+# serialized GET /cars and /cars/{id} responses, dropped by the writes that change them
+cache = response_cache.from_env()
+# writes are pushed to websocket subscribers once startup finds CHANGE_FEED_URL set
+feed = None
+name_index = None
+
+def get_name_index():
+  # postgres searches with its trigram index, anything else with an in-process index of car names
+  global name_index
+  if name_index is None and get_engine().dialect.name != 'postgresql':
+    name_index = NameIndex(get_engine())
+  return name_index
+
+def as_utc(value):
+  # created_at is stored as naive UTC
+  return value.astimezone(timezone.utc).replace(tzinfo=None) if value is not None and value.tzinfo else value
+
+def publish_change(op, car=None, before=None, car_id=None):
+  if feed is not None:
+    feed.emit(op, car, before, car_id)
+
+def cached_json(request, entry, hit):
+  headers = {**entry.headers, 'ETag': entry.etag, 'X-Cache': 'HIT' if hit else 'MISS'}
+  if etag_matches(request.headers.get('if-none-match'), entry.etag):
+    return Response(status_code=304, headers=headers)
+  return Response(entry.body, media_type='application/json', headers=headers)
+
+# columns GET /cars can sort by, each backed by an index that ends in id
+SORT_COLUMNS = {
+  'id': Car.id,
+  'price_mdl': Car.price_mdl,
+  'kilometrage': Car.kilometrage,
+  'created_at': Car.created_at,
+}
+
+def encode_cursor(values):
+  # opaque for clients, just the position of the last row they saw
+  return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort='id'):
+  try:
+    values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    values['id'] = int(values['id'])
+    if values.get('s', 'id') != sort:
+      raise ValueError('cursor belongs to another sort order')
+    if sort == 'id' or sort in SORT_COLUMNS and values.get('v') is None:
+      # a sorted listing's cursor has no value once it reached the cars without one
+      values['v'] = None
+    elif sort == 'created_at':
+      values['v'] = datetime.fromisoformat(values['v'])
+    else:
+      values['v'] = float(values['v'])
+    return values
+  except (ValueError, TypeError, KeyError):
+    raise HTTPException(status_code=400, detail='Invalid cursor')
+
+def cursor_after(car, sort='id'):
+  if sort == 'id':
+    return encode_cursor({'id': car.id})
+  value = getattr(car, sort)
+  return encode_cursor({'s': sort, 'v': value.isoformat() if isinstance(value, datetime) else value, 'id': car.id})
+
+def cars_query(limit, offset=0, position=None, sort='id', price_min=None, price_max=None, colors=None,
+               kilometrage_max=None, created_after=None, created_before=None, nulls=False):
+  # builds the GET /cars query, the sort order always ends in id so keyset paging is stable
+  # sorted listings are two runs, nulls picks the one of rows without a value, ordered by id alone
+  # position is a decoded cursor within the run
+  descending = sort.startswith('-')
+  sort_key = sort.lstrip('-')
+  column = SORT_COLUMNS[sort_key]
+
+  query = select(Car)
+  if price_min is not None:
+    query = query.filter(Car.price_mdl >= price_min)
+  if price_max is not None:
+    query = query.filter(Car.price_mdl <= price_max)
+  if colors:
+    query = query.filter(Car.color.in_(colors))
+  if kilometrage_max is not None:
+    query = query.filter(Car.kilometrage <= kilometrage_max)
+  if created_after is not None:
+    query = query.filter(Car.created_at >= created_after)
+  if created_before is not None:
+    query = query.filter(Car.created_at < created_before)
+
+  if sort_key == 'id' or nulls:
+    if nulls:
+      query = query.filter(column.is_(None))
+    query = query.order_by(Car.id.desc() if descending else Car.id)
+    if position is not None:
+      query = query.filter(Car.id < position['id'] if descending else Car.id > position['id'])
+  else:
+    query = query.filter(column.isnot(None))
+    query = query.order_by(*([column.desc(), Car.id.desc()] if descending else [column, Car.id]))
+    if position is not None:
+      key = tuple_(column, Car.id)
+      after = (position['v'], position['id'])
+      query = query.filter(key < after if descending else key > after)
+  if position is None:
+    query = query.offset(offset)
+  return query.limit(limit)
+
+async def read_car_page(db, limit, offset=0, cursor=None, sort='id', **filters):
+  # sorted listings put cars without a value last (NULLS LAST) without giving up the (value, id) indexes:
+  # the rows with a value are one index range, the rest another one ordered by id, read when the first runs out
+  sort_key = sort.lstrip('-')
+  position = decode_cursor(cursor, sort_key) if cursor else None
+  in_nulls = sort_key != 'id' and position is not None and position['v'] is None
+  cars = []
+  if not in_nulls:
+    cars = (await db.execute(cars_query(limit, offset, position, sort, **filters))).scalars().all()
+  if sort_key != 'id' and len(cars) < limit:
+    null_offset = 0
+    if position is None and offset and not cars:
+      # the offset went past every row with a value, the rest of it applies to the null run
+      valued = cars_query(None, 0, None, sort, **filters).order_by(None).subquery()
+      null_offset = max(0, offset - (await db.execute(select(func.count()).select_from(valued))).scalar())
+    query = cars_query(limit - len(cars), null_offset, position if in_nulls else None, sort, nulls=True, **filters)
+    cars += (await db.execute(query)).scalars().all()
+  return cars
+
+def search_query(q, limit, after=None):
+  # every word has to appear in the name, the GiST trigram index of car_search_names serves those filters and
+  # walks the matching names nearest first in name <-> q order, each name then reads its cars from (name, id)
+  # in id order, the cursor carries the distance and id breaks ties for keyset paging
+  # the planner only uses the index for the bare operator in ORDER BY, so the distance stays uncast
+  # ids start at 1, so names ranked past the cursor's distance read from their first car
+  nearest = search_names.c.name.op('<->', return_type=Double)(q)
+  ranked = select(search_names.c.name, nearest.label('distance')).where(*[search_names.c.name.ilike(f'%{word}%') for word in search_words(q)])
+  if after is not None:
+    ranked = ranked.where(nearest >= after[0])
+  ranked = ranked.order_by(nearest).subquery()
+  cars = select(Car).where(Car.name == ranked.c.name)
+  if after is not None:
+    cars = cars.where(Car.id > case((ranked.c.distance > after[0], 0), else_=after[1]))
+  cars = cars.order_by(Car.id).limit(limit).lateral()
+  car = aliased(Car, cars)
+  return select(car, ranked.c.distance).join_from(ranked, cars, true()).order_by(ranked.c.distance, car.id).limit(limit)
+
+async def search_name_index(db, q, limit, after=None):
+  # candidates come from the index, a car renamed or deleted since it was read is skipped
+  results = []
+  while len(results) < limit:
+    wanted = limit - len(results)
+    matches = await to_thread.run_sync(get_name_index().page, q, after, wanted)
+    if not matches:
+      break
+    cars = (await db.execute(select(Car).where(Car.id.in_([car_id for _, car_id, _ in matches])))).scalars()
+    found = {car.id: car for car in cars}
+    for score, car_id, name in matches:
+      car = found.get(car_id)
+      if car is not None and car.name == name:
+        results.append((score, car))
+    if len(matches) < wanted:
+      break
+    after = matches[-1][:2]
+  return results
 
-  class Config:
-    from_attributes = True
-    
 @app.post('/cars', response_model=CarResponse, status_code=200)
-def create_car(car: CarCreate, db: Session = Depends(get_db)):
+async def create_car(car: CarCreate, db: AsyncSession = Depends(get_async_db)):
   car = Car(**car.dict())
   db.add(car)
-  db.commit()
-  db.refresh(car)
+  await db.commit()
+  await db.refresh(car)
+  cache.invalidate_car(car.id, car_image(car))
+  publish_change('created', car_event(car), car_id=car.id)
   return car
 
+@app.post('/cars/bulk', response_model=BulkResponse)
+async def create_cars_bulk(cars: List[CarCreate], db: AsyncSession = Depends(get_async_db)):
+  # one transaction for the whole request, existing links are updated in place
+  # ids and replaced rows are only looked up when there is a change feed to tell
+  changes = [] if feed is not None else None
+  inserted, updated = await db.run_sync(bulk_upsert_cars, [car.dict() for car in cars], changes=changes)
+  await db.commit()
+  cache.invalidate_links([car.link for car in cars])
+  for car_id, car, before in changes or ():
+    publish_change('upserted', car_event(car), before, car_id)
+  return {'received': len(cars), 'inserted': inserted, 'updated': updated}
+
 @app.get('/')
 def read_root():
   return {'message': 'welcome to the car API'}
 
+@app.get('/health')
+async def read_health():
+  # liveness only, the cluster balancer polls it and shouldn't wait on the database
+  return {'status': 'ok', 'pid': os.getpid()}
+
+@app.get('/cache/stats')
+def read_cache_stats():
+  return cache.stats()
+
+@app.get('/metrics')
+def read_metrics():
+  return {**metrics.snapshot(), 'response_cache': cache.stats(), 'change_feed': feed.stats() if feed else None}
+
+@app.on_event('startup')
+async def startup():
+  # the schema is checked here rather than at import, an unreachable database fails startup, not import
+  global feed
+  await to_thread.run_sync(init_db)
+  metrics.startup.mark('schema_ready')
+  if os.getenv('CHANGE_FEED_URL') and feed is None:
+    from websocket.change_feed import ChangePublisher
+    feed = ChangePublisher(os.getenv('CHANGE_FEED_URL'))
+    feed.start()
+  metrics.startup.mark('ready')
+
+@app.on_event('shutdown')
+def close_request_log():
+  if metrics.request_log is not None:
+    metrics.request_log.close()
+
 @app.get('/cars', response_model=List[CarResponse])
-def read_cars(db: Session = Depends(get_db), limit: int = Query(default=10, ge=1), offset: int = Query(default=0, ge=0)):
-  cars = db.query(Car).offset(offset).limit(limit).all()
-  return cars
+async def read_cars(
+  request: Request,
+  db: AsyncSession = Depends(get_async_db),
+  limit: int = Query(default=10, ge=1),
+  offset: int = Query(default=0, ge=0),
+  cursor: Optional[str] = None,
+  sort: str = Query(default='id', pattern='^-?(id|price_mdl|kilometrage|created_at)$'),
+  price_min: Optional[float] = None,
+  price_max: Optional[float] = None,
+  color: Optional[List[str]] = Query(default=None),
+  kilometrage_max: Optional[int] = None,
+  created_after: Optional[datetime] = None,
+  created_before: Optional[datetime] = None,
+):
+  created_after, created_before = as_utc(created_after), as_utc(created_before)
+  colors = tuple(sorted(set(color))) if color else None
+  filters = {
+    'sort': sort, 'price_min': price_min, 'price_max': price_max, 'colors': colors,
+    'kilometrage_max': kilometrage_max, 'created_after': created_after, 'created_before': created_before,
+  }
+  key = ('cars', limit, offset if cursor is None else 0, cursor, *filters.values())
+  entry = cache.get(key)
+  if entry is not None:
+    return cached_json(request, entry, hit=True)
+
+  generation = cache.generation
+  # with a cursor every page is an index seek, offset is still accepted for old clients
+  cars = await read_car_page(db, limit, offset, cursor, sort, price_min=price_min, price_max=price_max, colors=colors,
+                             kilometrage_max=kilometrage_max, created_after=created_after, created_before=created_before)
+  headers = {}
+  if len(cars) == limit:
+    headers['X-Next-Cursor'] = cursor_after(cars[-1], sort.lstrip('-'))
+  entry = CachedResponse(cars_adapter.dump_json([CarResponse.model_validate(car) for car in cars]), headers, filters=filters)
+  return cached_json(request, cache.put(key, entry, generation), hit=False)
+
+@app.get('/cars/stats')
+async def read_car_stats(db: AsyncSession = Depends(get_async_db)):
+  # read from the trigger-maintained car_stats table, the cost doesn't grow with the catalog
+  return await read_stats(db)
+
+@app.get('/cars/search', response_model=List[CarResponse])
+async def search_cars(
+  q: str = Query(min_length=1, max_length=200),
+  limit: int = Query(default=10, ge=1),
+  cursor: Optional[str] = None,
+  db: AsyncSession = Depends(get_async_db),
+):
+  if not search_words(q):
+    raise HTTPException(status_code=400, detail='Search needs at least one letter or digit')
+  after = None
+  if cursor:
+    position = decode_cursor(cursor, 'rank')
+    after = (position['v'], position['id'])
+
+  if get_name_index() is None:
+    results = [(score, car) for car, score in (await db.execute(search_query(q, limit, after))).all()]
+  else:
+    results = await search_name_index(db, q, limit, after)
+  headers = {}
+  if len(results) == limit:
+    score, car = results[-1]
+    headers['X-Next-Cursor'] = encode_cursor({'s': 'rank', 'v': score, 'id': car.id})
+  body = cars_adapter.dump_json([CarResponse.model_validate(car) for _, car in results])
+  return Response(body, media_type='application/json', headers=headers)
+
+@app.get('/cars/export')
+def export_all_cars(format: str = Query(default='ndjson', pattern='^(ndjson|csv|compact)$'), gzip: bool = False):
+  # streams the whole table, rows go out as the cursor produces them
+  headers = {'Content-Disposition': f'attachment; filename="cars.{EXPORT_FORMATS[format].extension}"'}
+  if gzip:
+    headers['Content-Encoding'] = 'gzip'
+  return StreamingResponse(export_cars(format, compress=gzip), media_type=EXPORT_FORMATS[format].media_type, headers=headers)
 
 @app.get('/cars/{car_id}', response_model=CarResponse)
-def read_car(car_id: int, db: Session = Depends(get_db)):
-  car = db.query(Car).filter(Car.id == car_id).first()
+async def read_car(car_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+  entry = cache.get(('car', car_id))
+  if entry is not None:
+    return cached_json(request, entry, hit=True)
+
+  generation = cache.generation
+  car = await db.get(Car, car_id)
   if car is None:
     raise HTTPException(status_code=404, detail='Car not found')
-  return car
+  entry = CachedResponse(CarResponse.model_validate(car).model_dump_json().encode(), link=car.link)
+  return cached_json(request, cache.put(('car', car_id), entry, generation), hit=False)
 
 @app.put('/cars/{car_id}', response_model=CarResponse)
-def update_car(car_id: int, car: CarCreate, db: Session = Depends(get_db)):
-  car_db = db.query(Car).filter(Car.id == car_id).first()
+async def update_car(car_id: int, car: CarCreate, db: AsyncSession = Depends(get_async_db)):
+  car_db = await db.get(Car, car_id)
   if car_db is None:
     raise HTTPException(status_code=404, detail='Car not found')
+  before = car_image(car_db)
   for key, value in car.dict().items():
     setattr(car_db, key, value)
   car_db.updated_at = datetime.utcnow()
-  db.commit()
-  db.refresh(car_db)
+  await db.commit()
+  await db.refresh(car_db)
+  cache.invalidate_car(car_id, before, car_image(car_db))
+  publish_change('updated', car_event(car_db), before, car_id)
   return car_db
 
 @app.delete('/cars/{car_id}')
-def delete_car(car_id: int, db: Session = Depends(get_db)):
-  car = db.query(Car).filter(Car.id == car_id).first()
+async def delete_car(car_id: int, db: AsyncSession = Depends(get_async_db)):
+  car = await db.get(Car, car_id)
   if car is None:
     raise HTTPException(status_code=404, detail='Car not found')
-  db.delete(car)
-  db.commit()
+  before = car_image(car)
+  await db.delete(car)
+  await db.commit()
+  cache.invalidate_car(car_id, before)
+  publish_change('deleted', before=before, car_id=car_id)
   return {'message': 'Car deleted'}
 
+# upload bodies are parsed in chunks of this many bytes and written in batches of this many cars
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_BATCH_SIZE = int(os.getenv('UPLOAD_BATCH_SIZE', '1000'))
+
 @app.post('/upload/')
-async def upload_file(file: UploadFile = File(...)):
-  try:
-    if file.content_type != 'application/json':
-      raise HTTPException(status_code=400, detail='Only JSON files are allowed')
-    content = await file.read()
+async def upload_file(file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
+  # products_filtered is read item by item from the upload, memory stays at one chunk plus one batch
+  if (file.content_type or '').split(';')[0].strip() != 'application/json':
+    raise HTTPException(status_code=400, detail='Only JSON files are allowed')
+
+  started = time.perf_counter()
+  summary = {'received': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'batches': 0, 'bytes': 0}
+  timings = {'parse': 0.0, 'database': 0.0}
+  stream = ArrayItemStream('products_filtered')
+  batch = []
+
+  async def flush():
+    # every batch is its own transaction, a failure keeps what was already written and re-uploading is safe
+    db_started = time.perf_counter()
+    changes = [] if feed is not None else None
+    inserted, updated = await db.run_sync(bulk_upsert_cars, batch, changes=changes)
+    await db.commit()
+    timings['database'] += time.perf_counter() - db_started
+    cache.invalidate_links([car['link'] for car in batch])
+    for car_id, car, before in changes or ():
+      publish_change('upserted', car_event(car), before, car_id)
+    summary['inserted'] += inserted
+    summary['updated'] += updated
+    summary['batches'] += 1
+    batch.clear()
+
+  while True:
+    data = await file.read(UPLOAD_CHUNK_SIZE)
+    summary['bytes'] += len(data)
+    parse_started = time.perf_counter()
+    # only parse errors are the client's, a ValueError out of flush() is a server error
     try:
-      data = json.loads(content)
-      print("Received data:", json.dumps(data, indent=2))
-      cars = data.get('products_filtered', [])
-      db = next(get_db())
-      for car in cars:
-        car = Car(
-          name=car_data.get('name', ''),
-          price_mdl=car_data.get('price_mdl', 0.0),
-          link=car_data.get('link', ''),
-          kilometrage=car_data.get('kilometrage', 0),
-          color=car_data.get('color', '')
-        )
-        db.add(car)
-      db.commit()
-      return{"message": "File uploaded successfully", "content": data}
-    except json.JSONDecodeError:
-      raise HTTPException(status_code=400, detail='Invalid JSON file')
-  except Exception as e:
-    raise HTTPException(status_code=500, detail=str(e))
+      items = stream.feed(data, final=not data)
+    except ValueError as e:
+      detail = f"Invalid JSON file after {summary['bytes']} bytes: {e}"
+      if summary['batches']:
+        detail += f" ({summary['inserted'] + summary['updated']} cars already stored)"
+      raise HTTPException(status_code=400, detail=detail)
+    timings['parse'] += time.perf_counter() - parse_started
+    for item in items:
+      summary['received'] += 1
+      car = car_row(item)
+      if car is None:
+        summary['skipped'] += 1
+        continue
+      batch.append(car)
+      if len(batch) >= UPLOAD_BATCH_SIZE:
+        await flush()
+    if not data:
+      break
+  if batch:
+    await flush()
+
+  summary['seconds'] = {key: round(value, 4) for key, value in {**timings, 'total': time.perf_counter() - started}.items()}
+  print(f"upload {file.filename}: {summary['received']} cars in {summary['batches']} batches, "
+        f"{summary['inserted']} inserted, {summary['updated']} updated, {summary['skipped']} skipped, {summary['seconds']['total']}s")
+  return {'message': 'File uploaded successfully', **summary}
 
 WEB_SERVER_NODES = [
   ('localhost', 8001),  # First server
@@ -117,10 +449,14 @@ def run_fastapi(host, port):
   uvicorn.run(app, host=host, port=port)
 
 async def main():
-  current_host = 'localhost'
-  current_port = 8001
-  
-  ftp_thread = start_ftp_processor()
+  # a single node, cluster.py runs all of WEB_SERVER_NODES behind a balancer
+  from websocket.websocket_server import server_url, start_server
+  current_host, current_port = WEB_SERVER_NODES[0]
+
+  os.environ.setdefault('CHANGE_FEED_URL', server_url())
+  if os.getenv('FTP_PROCESSOR') == '1':
+    from ftp_processor import start_ftp_processor
+    ftp_thread = start_ftp_processor()
   http_thread = threading.Thread(
     target=run_fastapi,
     args=(current_host, current_port),
@@ -130,5 +466,7 @@ async def main():
   websocket_task = asyncio.create_task(start_server())
   await websocket_task
 
+metrics.startup.mark('imported')
+
 if __name__ == '__main__':
-  asyncio.run(main())
\ No newline at end of file
+  asyncio.run(main())
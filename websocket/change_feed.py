@@ -0,0 +1,248 @@
+# change_feed.py
+# car change events: API nodes publish them to the websocket server, which fans them out to filtered subscriptions
+import asyncio
+import json
+import os
+import threading
+import time
+import websockets
+
+# events are coalesced per car and sent once per tick
+FEED_TICK_MS = float(os.getenv('FEED_TICK_MS', '100'))
+# publishers have to send it when set
+FEED_TOKEN = os.getenv('FEED_TOKEN', '')
+# events a publisher holds while the websocket server is unreachable, newer ones are dropped
+FEED_MAX_PENDING = int(os.getenv('FEED_MAX_PENDING', '50000'))
+# a subscriber with more unsent bytes than this is disconnected, it can resubscribe and resync from GET /cars
+FEED_MAX_BUFFER = int(os.getenv('FEED_MAX_BUFFER', str(1024 * 1024)))
+
+# an event is {'op', 'id', 'car', 'before'}, op one of created, updated, deleted or upserted
+# car is the row after the write and before the row it replaced, None for inserts and deletes
+
+def event_key(event):
+  # every op carries the car's id, so all the writes to one car within a tick fold together
+  return int(event['id'])
+
+def coalesce(pending, event):
+  # folds event into pending, which holds the net change per car since the last tick
+  key = event_key(event)
+  previous = pending.get(key)
+  if previous is None:
+    pending[key] = event
+  elif previous['op'] == 'created':
+    if event['op'] == 'deleted':
+      # created and gone within one tick, nobody needs to hear about it
+      del pending[key]
+    else:
+      pending[key] = {**event, 'op': 'created', 'before': None}
+  else:
+    # keeps the image subscribers last saw, so a filter can still tell the car left it
+    pending[key] = {**event, 'before': previous.get('before')}
+
+class FeedFilter:
+  # what a subscription asks for, subscriptions with equal filters share one group
+  def __init__(self, price_min=None, price_max=None, colors=None, kilometrage_max=None):
+    self.price_min = price_min
+    self.price_max = price_max
+    self.colors = colors
+    self.kilometrage_max = kilometrage_max
+
+  @classmethod
+  def parse(cls, data):
+    # raises ValueError for anything that isn't a filter
+    data = data or {}
+    if not isinstance(data, dict):
+      raise ValueError('filter must be an object')
+    unknown = set(data) - {'price_min', 'price_max', 'color', 'kilometrage_max'}
+    if unknown:
+      raise ValueError(f"unknown filter fields: {', '.join(sorted(unknown))}")
+
+    def number(name):
+      value = data.get(name)
+      if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        raise ValueError(f'{name} must be a number')
+      return value
+
+    colors = data.get('color')
+    if isinstance(colors, str):
+      colors = [colors]
+    if colors is not None and not (isinstance(colors, list) and all(isinstance(color, str) for color in colors)):
+      raise ValueError('color must be a string or a list of strings')
+    return cls(number('price_min'), number('price_max'), frozenset(colors) if colors else None, number('kilometrage_max'))
+
+  @property
+  def key(self):
+    return (self.price_min, self.price_max, self.colors, self.kilometrage_max)
+
+  def describe(self):
+    return {
+      'price_min': self.price_min, 'price_max': self.price_max,
+      'color': sorted(self.colors) if self.colors else None, 'kilometrage_max': self.kilometrage_max,
+    }
+
+  def matches(self, car):
+    if car is None:
+      return False
+    price = car.get('price_mdl')
+    if self.price_min is not None and (price is None or price < self.price_min):
+      return False
+    if self.price_max is not None and (price is None or price > self.price_max):
+      return False
+    if self.colors and car.get('color') not in self.colors:
+      return False
+    kilometrage = car.get('kilometrage')
+    if self.kilometrage_max is not None and (kilometrage is None or kilometrage > self.kilometrage_max):
+      return False
+    return True
+
+  def view(self, event):
+    # the event as this filter's subscribers see it, None if it doesn't concern them
+    # an update that takes a car out of the filter reaches them as removed
+    after = self.matches(event['car'])
+    if event['op'] == 'deleted':
+      return {'op': 'deleted', 'id': event['id'], 'car': None} if self.matches(event['before']) else None
+    if after:
+      return {'op': event['op'], 'id': event['id'], 'car': event['car']}
+    if event['op'] in ('updated', 'upserted') and self.matches(event['before']):
+      return {'op': 'removed', 'id': event['id'], 'car': None}
+    return None
+
+class ChangeFeed:
+  # the websocket server side: takes published events and pushes them to subscribers once per tick
+  def __init__(self, tick=FEED_TICK_MS / 1000):
+    self.tick = tick
+    self.pending = {}
+    self.groups = {}  # filter key -> (FeedFilter, set of connections)
+    self.subscriptions = {}  # connection -> filter key
+    self.received = 0
+    self.sent = 0
+    self.serialized = 0
+    self.disconnected = 0
+
+  def subscribe(self, connection, feed_filter):
+    self.unsubscribe(connection)
+    group = self.groups.get(feed_filter.key)
+    if group is None:
+      group = self.groups[feed_filter.key] = (feed_filter, set())
+    group[1].add(connection)
+    self.subscriptions[connection] = feed_filter.key
+
+  def unsubscribe(self, connection):
+    key = self.subscriptions.pop(connection, None)
+    if key is None:
+      return False
+    clients = self.groups[key][1]
+    clients.discard(connection)
+    if not clients:
+      del self.groups[key]
+    return True
+
+  def publish(self, events):
+    for event in events:
+      coalesce(self.pending, event)
+    self.received += len(events)
+
+  def flush(self):
+    if not self.pending:
+      return
+    events = list(self.pending.values())
+    self.pending = {}
+    for feed_filter, clients in list(self.groups.values()):
+      view = [seen for seen in (feed_filter.view(event) for event in events) if seen is not None]
+      if not view:
+        continue
+      # one serialization per group however many subscribers share it
+      message = json.dumps({'type': 'changes', 'events': view}, default=str)
+      self.serialized += 1
+      ready = []
+      for connection in list(clients):
+        if connection.transport.get_write_buffer_size() > FEED_MAX_BUFFER:
+          self.disconnected += 1
+          self.unsubscribe(connection)
+          asyncio.ensure_future(connection.close(1013, 'change feed subscriber too slow'))
+        else:
+          ready.append(connection)
+      websockets.broadcast(ready, message)
+      self.sent += len(ready)
+
+  async def run(self):
+    while True:
+      await asyncio.sleep(self.tick)
+      self.flush()
+
+  def stats(self):
+    return {
+      'groups': len(self.groups), 'subscribers': len(self.subscriptions), 'received': self.received,
+      'serialized': self.serialized, 'sent': self.sent, 'disconnected': self.disconnected,
+    }
+
+class ChangePublisher:
+  # the API node side: collects events from the handlers and sends them to the websocket server once per tick
+  # publishing is best effort, subscribers that missed events resync from GET /cars
+  def __init__(self, url, tick=FEED_TICK_MS / 1000, token=FEED_TOKEN, max_pending=FEED_MAX_PENDING):
+    self.url = url
+    self.tick = tick
+    self.token = token
+    self.max_pending = max_pending
+    self.pending = {}
+    self.connected = False
+    self.published = 0
+    self.dropped = 0
+    self.task = None
+    self.loop = None
+
+  def emit(self, op, car=None, before=None, car_id=None):
+    # called on the event loop by the write handlers, never blocks
+    if len(self.pending) >= self.max_pending:
+      self.dropped += 1
+      return
+    coalesce(self.pending, {'op': op, 'id': car_id, 'car': car, 'before': before})
+
+  def start(self):
+    if self.task is None:
+      self.task = asyncio.get_running_loop().create_task(self.run())
+
+  def start_thread(self):
+    # for writers without an event loop, like the queue consumer: the publisher gets its own loop in a daemon thread
+    if self.loop is None:
+      self.loop = asyncio.new_event_loop()
+      threading.Thread(target=self.loop.run_forever, name='change-feed', daemon=True).start()
+      self.loop.call_soon_threadsafe(self.start)
+
+  def emit_threadsafe(self, op, car=None, before=None, car_id=None):
+    self.loop.call_soon_threadsafe(self.emit, op, car, before, car_id)
+
+  def stop_thread(self, timeout=2):
+    # lets the events emitted so far go out while the server is reachable, then stops the loop
+    deadline = time.monotonic() + timeout
+    time.sleep(self.tick * 2)
+    while self.pending and self.connected and time.monotonic() < deadline:
+      time.sleep(self.tick)
+    self.loop.call_soon_threadsafe(self.loop.stop)
+
+  async def run(self):
+    delay = 1
+    while True:
+      try:
+        async with websockets.connect(self.url) as connection:
+          print(f'change feed: publishing to {self.url}')
+          self.connected = True
+          delay = 1
+          while True:
+            await asyncio.sleep(self.tick)
+            if self.pending:
+              events = list(self.pending.values())
+              self.pending = {}
+              await connection.send(json.dumps({'action': 'publish', 'token': self.token, 'events': events}, default=str))
+              self.published += len(events)
+      except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+        if self.connected:
+          print(f'change feed: lost {self.url}: {e!r}')
+        self.connected = False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+
+  def stats(self):
+    return {'url': self.url, 'connected': self.connected, 'pending': len(self.pending), 'published': self.published, 'dropped': self.dropped}
+
+change_feed = ChangeFeed()
@@ -15,7 +15,7 @@ async def receive_messages(websocket):
 
 async def connect_to_chat():
   try:
-    async with websockets.connect('ws://localhost:8003') as websocket:
+    async with websockets.connect('ws://localhost:8765') as websocket:
       room_name = input("Enter room name to join: ")
       await websocket.send(json.dumps({
         "action": "join",
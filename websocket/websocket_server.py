@@ -1,6 +1,10 @@
 import asyncio
+import hmac
+import ipaddress
+import os
 import websockets
 import json
+from websocket.change_feed import FEED_TOKEN, FeedFilter, change_feed
 from collections import defaultdict
 from typing import Set, Dict
 
@@ -34,15 +38,53 @@ class ChatRoom:
 
 chat_room = ChatRoom()
 
+# kept off the web server node ports, 8001-8003
+WEBSOCKET_HOST = os.getenv('WEBSOCKET_HOST', 'localhost')
+WEBSOCKET_PORT = int(os.getenv('WEBSOCKET_PORT', '8765'))
+
+def may_publish(websocket, token):
+  # with FEED_TOKEN set publishers have to send it, without one only processes on this machine may publish
+  if FEED_TOKEN:
+    return isinstance(token, str) and hmac.compare_digest(token.encode(), FEED_TOKEN.encode())
+  try:
+    return ipaddress.ip_address(websocket.remote_address[0]).is_loopback
+  except (TypeError, ValueError, IndexError):
+    return False
+
+async def handle_feed_action(websocket, action, data):
+  # subscribe/unsubscribe for clients, publish for the API nodes
+  if action == 'subscribe':
+    try:
+      feed_filter = FeedFilter.parse(data.get('filter'))
+    except ValueError as e:
+      await websocket.send(json.dumps({"error": f"Invalid filter: {e}"}))
+      return
+    change_feed.subscribe(websocket, feed_filter)
+    await websocket.send(json.dumps({"message": "Subscribed to car changes", "filter": feed_filter.describe()}))
+  elif action == 'unsubscribe':
+    change_feed.unsubscribe(websocket)
+    await websocket.send(json.dumps({"message": "Unsubscribed from car changes"}))
+  elif not may_publish(websocket, data.get('token')):
+    await websocket.send(json.dumps({"error": "Invalid publish token"}))
+  else:
+    try:
+      change_feed.publish(data.get('events') or [])
+    except (KeyError, TypeError, ValueError, AttributeError):
+      await websocket.send(json.dumps({"error": "Invalid events"}))
+
 # the main websocket handler for joining, sending, and leaving rooms
-async def handle_connection(websocket: websockets.WebSocketServerProtocol, path: str):
+async def handle_connection(websocket: websockets.WebSocketServerProtocol, path: str = None):
   try:
     async for message in websocket:
       try:
         data = json.loads(message)
         action = data.get('action')
         room = data.get('room')
-        
+
+        if action in ('subscribe', 'unsubscribe', 'publish'):
+          await handle_feed_action(websocket, action, data)
+          continue
+
         if not room:
           await websocket.send(json.dumps({"error": "Room name is required"}))
           continue
@@ -73,12 +115,24 @@ async def handle_connection(websocket: websockets.WebSocketServerProtocol, path:
     for room, clients in chat_room.clients.items():
       if websocket in clients:
         await chat_room.leave_room(websocket, room)
+  finally:
+    change_feed.unsubscribe(websocket)
+
+def server_url(host=WEBSOCKET_HOST, port=WEBSOCKET_PORT):
+  # how processes on this machine reach the server, the API nodes publish car changes here
+  return f"ws://{'localhost' if host in ('', '0.0.0.0') else host}:{port}"
 
-async def start_server():
-  async with websockets.serve(handle_connection, "localhost", 8003) as server:
-    print("WebSocket server is running on ws://localhost:8003")
-    # runs forever
-    await asyncio.Future()
+async def start_server(host=WEBSOCKET_HOST, port=WEBSOCKET_PORT):
+  async with websockets.serve(handle_connection, host, port) as server:
+    print(f"WebSocket server is running on ws://{host}:{port}")
+    # pushes the car changes the API nodes publish, once per tick
+    # the loop only keeps weak references to tasks, this one holds it for the server's lifetime
+    feed_task = asyncio.create_task(change_feed.run())
+    try:
+      # runs forever
+      await asyncio.Future()
+    finally:
+      feed_task.cancel()
 
 def main():
   try: